@@ -0,0 +1,359 @@
+import os
+import json
+import mmap
+import zlib
+import lzma
+import struct
+import logging
+from pathlib import Path
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+archive_suffix = ".mwz"
+archive_magic = b"MWZ\x01"
+archive_version = 1
+
+# 解压时都释放 GIL，多个块可以在线程里并行解压
+codecs = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lambda data: lzma.decompress(data)),
+}
+default_levels = {"zlib": 6, "lzma": 6, "zstd": 3}
+try:  # 可选依赖，压缩率和 zlib 相当，解压快两倍以上
+    import zstandard
+
+    codecs["zstd"] = (lambda data, level: zstandard.compress(data, level), zstandard.decompress)
+except ImportError:
+    zstandard = None
+default_codec = "zstd" if "zstd" in codecs else "zlib"
+filters = ["none", "shuffle", "delta"]
+delta_lag = 8  # 4 rx * IQ，相隔 delta_lag 个 int16 是同一通道的下一个 ADC 采样
+
+_pool: ThreadPoolExecutor = None
+_pool_lock = Lock()
+
+
+def _reset_pool():
+    global _pool, _pool_lock
+    _pool, _pool_lock = None, Lock()  # fork 出的子进程里没有父进程的线程
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool)
+
+
+def decompress_pool():
+    """Threads shared by every open archive to decompress the chunks of one read in parallel."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="mwz")
+        return _pool
+
+
+def encode_chunk(frames: np.ndarray, filter: str):
+    """(frames, items) int16 -> bytes to compress.
+
+    shuffle groups the low and the high bytes of all samples, the high bytes of ADC data vary
+    slowly and compress well. delta also replaces every sample by its difference to the previous
+    ADC sample of the same channel (wrapping int16, so it stays lossless) before the shuffle.
+    """
+    data = np.ascontiguousarray(frames, dtype=np.int16)
+    if filter == "delta":
+        lagged = data.reshape(data.shape[0], -1, delta_lag)
+        data = np.diff(lagged, axis=1, prepend=np.zeros_like(lagged[:, :1]))
+    if filter in ("shuffle", "delta"):
+        return data.view(np.uint8).reshape(-1, 2).T.tobytes()
+    return data.tobytes()
+
+
+def decode_chunk(data: bytes, filter: str, frames: int):
+    """Inverse of encode_chunk, (frames, items) int16."""
+    if filter in ("shuffle", "delta"):
+        planes = np.frombuffer(data, dtype=np.uint8).reshape(2, -1)
+        out = np.empty((planes.shape[1], 2), dtype=np.uint8)
+        out[:, 0], out[:, 1] = planes
+        out = out.view(np.int16).reshape(frames, -1)
+    else:
+        out = np.frombuffer(data, dtype=np.int16).reshape(frames, -1)
+    if filter == "delta":
+        out = np.cumsum(out.reshape(frames, -1, delta_lag), axis=1, dtype=np.int16).reshape(frames, -1)
+    return out
+
+
+def read_header(path: Path):
+    """json header of a *_data.mwz file and the file position right after it."""
+    with Path(path).open("rb") as f:
+        magic, header_len = f.read(4), struct.unpack("<I", f.read(4))[0]
+        if magic != archive_magic:
+            raise ValueError(f"{path} is not a capture archive")
+        header = json.loads(f.read(header_len))
+    if header["version"] != archive_version:
+        raise ValueError(f"capture archive version {header['version']} != {archive_version}")
+    return header, 8 + header_len
+
+
+class ArchiveFile:
+    """One compressed *_data.mwz file: a json header, a chunk offset table and the compressed chunks.
+
+    Layout: magic, uint32 header length, json header, uint64 offsets of the n_chunks + 1 chunk
+    boundaries, chunk payloads. Every chunk holds chunk_frames frames (the last one may hold fewer)
+    so any frame is found without reading the others. Decompressed chunks are kept in a small LRU.
+    """
+
+    def __init__(self, path: Path, cache_size: int = 8):
+        self.path = Path(path)
+        self.header, table_pos = read_header(self.path)
+        self.frames = self.header["frames"]
+        self.frame_items = self.header["frame_items"]
+        self.chunk_frames = self.header["chunk_frames"]
+        self.filter = self.header["filter"]
+        if self.header["codec"] not in codecs:
+            raise ValueError(f"{self.path} is compressed with {self.header['codec']}, install its package to read it")
+        self.decompress = codecs[self.header["codec"]][1]
+        chunks_num = -(-self.frames // self.chunk_frames)
+        self.offsets = np.fromfile(self.path, dtype="<u8", count=chunks_num + 1, offset=table_pos)
+        with self.path.open("rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cache_size = cache_size
+        self._cache: OrderedDict[int, np.ndarray] = OrderedDict()
+        self._cache_lock = Lock()
+
+    def _decode(self, chunk_i: int):
+        start, end = int(self.offsets[chunk_i]), int(self.offsets[chunk_i + 1])
+        frames = min(self.chunk_frames, self.frames - chunk_i * self.chunk_frames)
+        return decode_chunk(self.decompress(memoryview(self._mmap)[start:end]), self.filter, frames)
+
+    def chunks(self, chunk_ids: np.ndarray) -> dict[int, np.ndarray]:
+        """Decompressed chunks by id, the ones not cached are decompressed in parallel."""
+        with self._cache_lock:
+            found = {i: self._cache[i] for i in chunk_ids if i in self._cache}
+            for i in found:
+                self._cache.move_to_end(i)
+        missing = [int(i) for i in chunk_ids if i not in found]
+        if len(missing) > 1:
+            found.update(zip(missing, decompress_pool().map(self._decode, missing)))
+        elif missing:
+            found[missing[0]] = self._decode(missing[0])
+        with self._cache_lock:
+            for i in missing[max(0, len(missing) - self.cache_size) :]:
+                self._cache[i] = found[i]
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return found
+
+    def read(self, frames: np.ndarray) -> np.ndarray:
+        """(len(frames), frame_items) int16 of the given frame numbers."""
+        frames = np.asarray(frames, dtype=np.int64)
+        if frames.size and (frames.min() < 0 or frames.max() >= self.frames):
+            raise IndexError(f"frame out of range 0~{self.frames - 1}")
+        chunk_of = frames // self.chunk_frames
+        chunk_ids = np.unique(chunk_of)
+        chunks = self.chunks(chunk_ids)
+        out = np.empty((frames.shape[0], self.frame_items), dtype=np.int16)
+        for i in chunk_ids:
+            sel = np.flatnonzero(chunk_of == i)
+            out[sel] = chunks[int(i)][frames[sel] - i * self.chunk_frames]
+        return out
+
+    def close(self):
+        self._mmap.close()
+
+
+class ArchiveArray:
+    """A *_data.mwz file seen as the (frame, chirp, 12, 4, samples, 2) array load_bin_file returns.
+
+    Indexing the frame axis (int, slice or index array, plus trailing indexes of the other axes)
+    only decompresses the chunks holding the selected frames.
+    """
+
+    def __init__(self, path: Path, samples_num: int, chrips_num: int, frames_num: int = None):
+        self.file = ArchiveFile(path)
+        frames = self.file.frames if frames_num is None else min(frames_num, self.file.frames)
+        self.raw_shape = (chrips_num, 12, samples_num, 4, 2)
+        if np.prod(self.raw_shape) != self.file.frame_items:
+            raise ValueError(f"{path} holds frames of {self.file.frame_items} items, expected {np.prod(self.raw_shape)}")
+        self.shape = (frames, chrips_num, 12, 4, samples_num, 2)
+        self.dtype = np.dtype(np.int16)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        i, args = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        frames = np.arange(self.shape[0])[i]
+        data = self.file.read(np.atleast_1d(frames)).reshape(-1, *self.raw_shape)
+        data = data.transpose(0, 1, 2, 4, 3, 5)
+        if np.ndim(frames) == 0:
+            return data[0][args]
+        return data[(slice(None), *args)]
+
+
+def data_file_frames(path: Path, frame_size: int):
+    """Whole frames in a raw *_data.bin or an archived *_data.mwz file."""
+    path = Path(path)
+    if path.suffix == archive_suffix:
+        return read_header(path)[0]["frames"]
+    return path.stat().st_size // frame_size
+
+
+def source_stat(path: Path):
+    """(name, [size, mtime_ns]) of the raw file an archive was made from, or of the raw file itself.
+
+    The cache manifest keeps seeing the same sources after a capture is archived, so its repacked
+    outputs stay valid.
+    """
+    path = Path(path)
+    if path.suffix == archive_suffix:
+        source = read_header(path)[0]["source"]
+        return source["name"], [source["size"], source["mtime_ns"]]
+    stat = path.stat()
+    return path.name, [stat.st_size, stat.st_mtime_ns]
+
+
+def write_archive(
+    bin_path: Path,
+    frame_items: int,
+    chunk_frames: int = 16,
+    codec: str = default_codec,
+    level: int = None,
+    filter: str = "shuffle",
+    jobs: int = None,
+    verify=True,
+):
+    """Compress one raw *_data.bin into a *_data.mwz next to it.
+
+    The chunks are compressed in a thread pool, a window of chunks at a time so the memory stays
+    bounded, and the file is renamed into place only when complete (and verified).
+    """
+    bin_path = Path(bin_path)
+    archive_path = bin_path.with_suffix(archive_suffix)
+    stat = bin_path.stat()
+    raw = np.memmap(bin_path, dtype=np.int16, mode="r")
+    if raw.shape[0] % frame_items:
+        raise ValueError(f"{bin_path} size is not a whole number of frames")
+    raw = raw.reshape(-1, frame_items)
+    frames = raw.shape[0]
+    chunks_num = -(-frames // chunk_frames)
+    compress = codecs[codec][0]
+    level = default_levels[codec] if level is None else level
+    header = json.dumps(
+        {
+            "version": archive_version,
+            "frames": frames,
+            "frame_items": frame_items,
+            "chunk_frames": chunk_frames,
+            "codec": codec,
+            "level": level,
+            "filter": filter,
+            "source": {"name": bin_path.name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        }
+    ).encode()
+
+    def compress_chunk(chunk_i):
+        return compress(encode_chunk(raw[chunk_i * chunk_frames : (chunk_i + 1) * chunk_frames], filter), level)
+
+    tmp_path = archive_path.with_name(archive_path.name + ".tmp")
+    offsets = np.zeros(chunks_num + 1, dtype="<u8")
+    jobs = jobs or os.cpu_count() or 1
+    with tmp_path.open("wb") as f, ThreadPoolExecutor(max_workers=jobs) as executor:
+        f.write(archive_magic + struct.pack("<I", len(header)) + header)
+        table_pos = f.tell()
+        f.write(offsets.tobytes())
+        offsets[0] = f.tell()
+        window = jobs * 4
+        for w0 in range(0, chunks_num, window):
+            for chunk_i, payload in enumerate(executor.map(compress_chunk, range(w0, min(w0 + window, chunks_num))), w0):
+                f.write(payload)
+                offsets[chunk_i + 1] = f.tell()
+        f.seek(table_pos)
+        f.write(offsets.tobytes())
+
+    if verify:
+        archive = ArchiveFile(tmp_path)
+        try:
+            for c0 in range(0, frames, chunk_frames * 64):
+                frame_ids = np.arange(c0, min(c0 + chunk_frames * 64, frames))
+                if not np.array_equal(archive.read(frame_ids), raw[frame_ids]):
+                    raise RuntimeError(f"{tmp_path} does not decompress to {bin_path}")
+        finally:
+            archive.close()
+    tmp_path.replace(archive_path)
+    return archive_path, stat.st_size, archive_path.stat().st_size
+
+
+def extract_archive(archive_path: Path):
+    """Restore the raw *_data.bin of a *_data.mwz, with its original mtime."""
+    archive = ArchiveFile(archive_path)
+    try:
+        source = archive.header["source"]
+        bin_path = Path(archive_path).with_name(source["name"])
+        tmp_path = bin_path.with_name(bin_path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            step = archive.chunk_frames * 16
+            for c0 in range(0, archive.frames, step):
+                archive.read(np.arange(c0, min(c0 + step, archive.frames))).tofile(f)
+        os.utime(tmp_path, ns=(source["mtime_ns"], source["mtime_ns"]))
+        tmp_path.replace(bin_path)
+    finally:
+        archive.close()
+    return bin_path
+
+
+def main():
+    import argparse
+    from .util import load_config
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Compress the raw *_data.bin files of captures losslessly, or restore them")
+    parser.add_argument("input_dirs", type=Path, nargs="+")
+    parser.add_argument("--codec", choices=list(codecs), default=default_codec)
+    parser.add_argument("--level", type=int, default=None, help="compression level, default per codec")
+    parser.add_argument(
+        "--filter", choices=filters, default="shuffle", help="delta suits data with strong low beat frequencies"
+    )
+    parser.add_argument("--chunk-frames", type=int, default=16, help="frames per compressed chunk")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="compression threads")
+    parser.add_argument("--delete", action="store_true", help="delete the raw files once their archive is verified")
+    parser.add_argument("--extract", action="store_true", help="restore the raw files from the archives")
+    args = parser.parse_args()
+
+    for input_dir in args.input_dirs:
+        if args.extract:
+            for archive_path in sorted(input_dir.glob(f"*_data{archive_suffix}")):
+                bin_path = extract_archive(archive_path)
+                if args.delete:
+                    archive_path.unlink()
+                _logger.info(f"{archive_path.name} -> {bin_path.name}")
+            continue
+
+        cfg = load_config(input_dir / "config.toml")
+        frame_items = cfg.mimo.frame.numLoops * 12 * cfg.mimo.profile.numAdcSamples * 4 * 2
+        raw_size = archive_size = 0
+        archived = []
+        for bin_path in sorted(input_dir.glob("*_data.bin")):
+            archive_path, size, compressed = write_archive(
+                bin_path, frame_items, args.chunk_frames, args.codec, args.level, args.filter, args.jobs
+            )
+            raw_size += size
+            archive_size += compressed
+            archived.append(bin_path)
+            _logger.info(f"{bin_path.name}: {size / 2**20:.0f} MB -> {compressed / 2**20:.0f} MB")
+        if args.delete:  # 全部归档并校验后才删除原始文件
+            for bin_path in archived:
+                bin_path.unlink()
+        if raw_size:
+            _logger.info(
+                f"{input_dir}: {raw_size / 2**20:.0f} MB -> {archive_size / 2**20:.0f} MB ({raw_size / archive_size:.2f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import logging
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from mmwave import schemas
+
+_logger = logging.getLogger(__name__)
+
+summary_file_name = "repack_summary.json"
+batch_summary_file_name = "batch_summary.json"
+
+
+def find_captures(root: Path):
+    """Every directory under root, root included, holding a config.toml and raw *_data.bin (or archived) files."""
+    root = Path(root)
+    captures = []
+    for config_path in sorted(root.rglob("config.toml")):
+        input_dir = config_path.parent
+        if any(input_dir.glob("master*_data.bin")) or any(input_dir.glob("master*_data.mwz")):
+            captures.append(input_dir)
+    return captures
+
+
+def output_names(cfg: schemas.MMWConfig):
+    """Outputs a repack with cfg writes, see repack.get_repack_outputs."""
+    from .repack import RepackROI
+
+    profile = cfg.repack.profile
+    prefix = RepackROI(cfg).prefix
+    names = []
+    if profile.raw_cube or not profile.range_fft:
+        names.append(prefix + "frame")
+    if profile.range_fft:
+        names.append(prefix + "range_profile")
+    return names
+
+
+def is_up_to_date(input_dir: Path, cfg: schemas.MMWConfig):
+    """Every output cfg asks for is fresh in the cache manifest, see cache.is_fresh."""
+    from .cache import is_fresh
+
+    return all(is_fresh(input_dir, cfg, name) for name in output_names(cfg))
+
+
+def capture_stats(input_dir: Path):
+    """Frame and drop statistics of a repacked capture for the summary."""
+    from .capture_index import load_capture_index
+    from .repack import load_valid_mask
+
+    index = load_capture_index(input_dir)
+    stats = {}
+    for device in index.devices:
+        gap_pos, gap_len = index.gaps(device)
+        stats[device] = {
+            "frames": int(index.timestamps(device).shape[0]),
+            "gaps": int(gap_pos.shape[0]),
+            "dropped": int(gap_len.sum()),
+            "longest_gap": int(gap_len.max(initial=0)),
+        }
+    mask_path = input_dir / "valid_mask.npz"
+    valid = float(load_valid_mask(mask_path).mean()) if mask_path.exists() else None
+    return {"devices": stats, "valid_ratio": valid}
+
+
+def repack_capture(input_dir: Path, cfg: schemas.MMWConfig):
+    """Repack one capture and write its repack_summary.json, failures end up in the summary too."""
+    from .repack import turn_frame
+
+    input_dir = Path(input_dir)
+    summary = {"input_dir": str(input_dir), "outputs": output_names(cfg)}
+    timings = {}
+    start = time.perf_counter()
+    try:
+        turn_frame(input_dir, cfg, timings)
+        summary.update(status="done", **capture_stats(input_dir))
+    except Exception as e:
+        _logger.exception(f"repack {input_dir} failed")
+        summary.update(status="failed", error=repr(e), traceback=traceback.format_exc())
+    summary.update(total=time.perf_counter() - start, timings=timings)
+    from .bench import capture_bytes
+
+    summary["raw_mb"] = capture_bytes(input_dir) / 2**20
+    write_summary(input_dir, summary)
+    return summary
+
+
+def write_summary(input_dir: Path, summary: dict):
+    tmp_path = input_dir / (summary_file_name + ".tmp")
+    tmp_path.write_text(json.dumps(summary, indent=2))
+    tmp_path.replace(input_dir / summary_file_name)
+
+
+def _worker_init():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.getLogger("mmwave.repack").setLevel(logging.WARNING)
+
+
+def run_batch(captures: list[tuple[Path, schemas.MMWConfig]], jobs: int = 4, io_jobs: int = 2):
+    """Repack captures in a process pool.
+
+    At most jobs captures run at once and at most io_jobs of them read from the same disk, so
+    captures spread over several disks run in parallel while one disk is not thrashed by many
+    sequential readers.
+
+    Return:
+        The summary of every capture, in the order of captures
+    """
+    if jobs < 1 or io_jobs < 1:  # io_jobs 为 0 时没有采集能开始，调度循环永远空转
+        raise ValueError(f"jobs and io_jobs must be at least 1, got {jobs} and {io_jobs}")
+    running = {}  # future -> (capture idx, disk)
+    disk_jobs: dict[int, int] = {}
+    summaries = [None] * len(captures)
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_worker_init) as executor:
+        order = list(range(len(captures)))
+        while order or running:
+            for i in list(order):
+                if len(running) >= jobs:
+                    break
+                input_dir, cfg = captures[i]
+                disk = input_dir.stat().st_dev
+                if disk_jobs.get(disk, 0) >= io_jobs:
+                    continue
+                disk_jobs[disk] = disk_jobs.get(disk, 0) + 1
+                running[executor.submit(repack_capture, input_dir, cfg)] = (i, disk)
+                order.remove(i)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, disk = running.pop(future)
+                disk_jobs[disk] -= 1
+                input_dir = captures[i][0]
+                try:
+                    summaries[i] = future.result()
+                except Exception as e:  # 子进程崩溃时 repack_capture 来不及写 summary
+                    summaries[i] = {"input_dir": str(input_dir), "status": "failed", "error": repr(e)}
+                summary = summaries[i]
+                if summary["status"] == "done":
+                    _logger.info(
+                        f"{input_dir}: {summary['total']:.1f}s, {summary['raw_mb'] / summary['total']:.1f} MB/s, "
+                        f"valid {summary['valid_ratio'] * 100:.2f}%"
+                    )
+                else:
+                    _logger.error(f"{input_dir}: {summary['error']}")
+    return summaries
+
+
+def main():
+    import argparse
+    from .cache import with_stored_profile
+    from .repack import add_profile_arguments, apply_profile_arguments
+    from .util import load_config
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Repack every capture found under a root directory")
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--jobs", type=int, default=4, help="captures repacked at the same time")
+    parser.add_argument("--io-jobs", type=int, default=2, help="captures read from the same disk at the same time")
+    parser.add_argument("--force", action="store_true", help="repack captures that are already up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only list the captures that would be repacked")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.jobs < 1 or args.io_jobs < 1:
+        parser.error("--jobs and --io-jobs must be at least 1")
+
+    captures, skipped, invalid = [], [], []
+    for input_dir in find_captures(args.root):
+        try:
+            cfg = apply_profile_arguments(load_config(input_dir / "config.toml"), args)
+            with_stored_profile(input_dir, cfg, output_names(cfg)[0])  # 保留上次命令行给的 layout / fill_gaps
+            up_to_date = not args.force and is_up_to_date(input_dir, cfg)
+        except (OSError, ValueError) as e:  # 一个采集的配置有误（如 roi 越界）时，其余采集照常重组
+            _logger.error(f"{input_dir}: invalid config, skipped: {e}")
+            summary = {"input_dir": str(input_dir), "status": "failed", "error": repr(e), "traceback": traceback.format_exc()}
+            if not args.dry_run:
+                write_summary(input_dir, summary)
+            invalid.append(summary)
+            continue
+        if cfg.repack.profile.workers is None:  # 多个采集同时重组时分摊 CPU
+            cfg.repack.profile.workers = max(1, (os.cpu_count() or 1) // args.jobs)
+        if up_to_date:
+            skipped.append(input_dir)
+        else:
+            captures.append((input_dir, cfg))
+    _logger.info(f"{len(captures)} captures to repack, {len(skipped)} up to date, {len(invalid)} invalid under {args.root}")
+    if args.dry_run:
+        for input_dir, _ in captures:
+            print(input_dir)
+        return
+
+    start = time.perf_counter()
+    summaries = run_batch(captures, args.jobs, args.io_jobs) + invalid
+    failed = [summary["input_dir"] for summary in summaries if summary["status"] != "done"]
+
+    batch_summary = {
+        "root": str(args.root),
+        "total": time.perf_counter() - start,
+        "repacked": [summary["input_dir"] for summary in summaries if summary["status"] == "done"],
+        "skipped": [str(input_dir) for input_dir in skipped],
+        "failed": failed,
+        "captures": summaries,
+    }
+    (args.root / batch_summary_file_name).write_text(json.dumps(batch_summary, indent=2))
+    _logger.info(f"batch done in {batch_summary['total']:.0f}s, {len(failed)} failed")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
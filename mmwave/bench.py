@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import itertools
+import multiprocessing
+from pathlib import Path
+
+from mmwave import schemas
+
+_logger = logging.getLogger(__name__)
+
+output_names = ["all_mmw_array.npy", "range_profile.npy", "valid_mask.npz", "capture_index.npz"]
+
+
+def capture_bytes(input_dir: Path):
+    """Size of the raw *_data.bin files of a capture, archived ones count with their uncompressed size."""
+    from .archive import archive_suffix, source_stat
+
+    paths = list(Path(input_dir).glob("*_data.bin")) + list(Path(input_dir).glob(f"*_data{archive_suffix}"))
+    return sum(source_stat(path)[1][0] for path in paths)
+
+
+def clean_outputs(input_dir: Path):
+    """Remove what an earlier repack wrote so every run starts from the raw files only."""
+    for name in output_names:
+        (input_dir / name).unlink(missing_ok=True)
+    for path in input_dir.glob("*.chunks"):
+        shutil.rmtree(path)
+
+
+def evict_page_cache(input_dir: Path):
+    """Drop the raw files from the page cache so a run reads them from disk again, Linux only."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in Path(input_dir).glob("*_data.bin"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _run_case(input_dir: Path, cfg: schemas.MMWConfig, queue):
+    from .repack import turn_frame
+
+    logging.getLogger("mmwave").setLevel(logging.WARNING)
+    timings = {}
+    start = time.perf_counter()
+    turn_frame(input_dir, cfg, timings)
+    total = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    queue.put({"total": total, "stages": timings, "peak_rss_mb": rss / 1024, "peak_worker_rss_mb": children_rss / 1024})
+
+
+def bench_case(input_dir: Path, cfg: schemas.MMWConfig, repeat: int = 1, cold=False):
+    """Time turn_frame on a capture.
+
+    Every run happens in a fresh spawned process so its peak RSS is not polluted by earlier runs,
+    with cold the raw files are evicted from the page cache before each run.
+    Return the run with the lowest total time, with MB/s of the raw data read.
+    """
+    input_dir = Path(input_dir)
+    ctx = multiprocessing.get_context("spawn")
+    raw_mb = capture_bytes(input_dir) / 2**20
+    runs = []
+    for _ in range(repeat):
+        clean_outputs(input_dir)
+        if cold:
+            evict_page_cache(input_dir)
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_case, args=(input_dir, cfg, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"repack benchmark run failed with exit code {process.exitcode}")
+        runs.append(queue.get())
+
+    best = min(runs, key=lambda run: run["total"])
+    return {**best, "raw_mb": raw_mb, "mb_per_s": raw_mb / best["total"], "runs": [run["total"] for run in runs]}
+
+
+def get_cases(cfg: schemas.MMWConfig, engines: list, streams: list, workers: list, readaheads: list = (None,)):
+    """Every combination of engine, stream, worker count and read-ahead as (name, cfg)."""
+    cases = []
+    for engine, stream, worker, readahead in itertools.product(engines, streams, workers, readaheads):
+        case_cfg = cfg.model_copy(deep=True)
+        case_cfg.repack.profile.engine = engine
+        case_cfg.repack.profile.stream = stream
+        case_cfg.repack.profile.workers = worker
+        name = f"{engine}{'-stream' if stream else ''}-j{worker or 'auto'}"
+        if readahead is not None:
+            case_cfg.repack.profile.readahead = readahead
+            name += f"-ra{readahead}"
+        cases.append((name, case_cfg))
+    return cases
+
+
+def main():
+    import argparse
+    from rich.console import Console
+    from rich.table import Table
+    from .util import load_config
+    from .synth import make_capture
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Benchmark repack throughput, peak memory and stage times")
+    parser.add_argument("input_dir", nargs="?", help="capture to repack, default a synthetic one in a temp dir")
+    parser.add_argument("--row", type=int, default=16, help="rows of the synthetic capture")
+    parser.add_argument("--col", type=int, default=128, help="cols of the synthetic capture")
+    parser.add_argument("--samples", type=int, default=256, help="ADC samples of the synthetic capture")
+    parser.add_argument("--drop-rate", type=float, default=0.001, help="dropped frames of the synthetic capture")
+    parser.add_argument("--engine", nargs="+", default=["process", "thread"], choices=["process", "thread"])
+    parser.add_argument("--stream", choices=["off", "on", "both"], default="both", help="write through a disk memmap")
+    parser.add_argument("-j", "--workers", type=int, nargs="+", default=[None], help="worker counts to compare")
+    parser.add_argument("--range-fft", action="store_true", help="also time the fused range FFT stage")
+    parser.add_argument("--readahead", type=int, nargs="+", default=[None], help="read-ahead lines to compare")
+    parser.add_argument("--prefetch", action="store_true", help="read ahead in a reader thread")
+    parser.add_argument("--cold", action="store_true", help="evict the raw files from the page cache before each run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest is reported")
+    parser.add_argument("--json", type=Path, help="also write the results to this file")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.input_dir:
+        input_dir = Path(args.input_dir)
+        cfg = load_config(input_dir / "config.toml")
+    else:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="mmw_bench_")
+        input_dir = Path(tmp_dir.name)
+        cfg = schemas.MMWConfig()
+        cfg.mimo.profile.numAdcSamples = args.samples
+        cfg.bracket.profile.row = args.row
+        cfg.bracket.profile.col = args.col
+        cfg.bracket.profile.offset_time = 0
+        cfg = make_capture(input_dir, cfg, drop_rate=args.drop_rate, jitter_us=100)
+    cfg.repack.profile.range_fft = args.range_fft
+    cfg.repack.profile.prefetch = args.prefetch
+
+    raw_mb = capture_bytes(input_dir) / 2**20
+    streams = {"off": [False], "on": [True], "both": [False, True]}[args.stream]
+    results = {}
+    try:
+        for name, case_cfg in get_cases(cfg, args.engine, streams, args.workers, args.readahead):
+            _logger.info(f"bench {name}")
+            results[name] = bench_case(input_dir, case_cfg, args.repeat, args.cold)
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    table = Table(title=f"repack {input_dir}, {raw_mb:.0f} MB raw (time s, RSS MB)")
+    stages = ["index", "mask", "repack", "finish"]
+    for column in ["case", "MB/s", "total", *stages, "RSS", "worker RSS"]:
+        table.add_column(column, justify="right")
+    for name, result in results.items():
+        table.add_row(
+            name,
+            f"{result['mb_per_s']:.1f}",
+            f"{result['total']:.2f}",
+            *[f"{result['stages'].get(stage, 0):.2f}" for stage in stages],
+            f"{result['peak_rss_mb']:.0f}",
+            f"{result['peak_worker_rss_mb']:.0f}",
+        )
+    Console().print(table)
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+from mmwave import schemas
+
+_logger = logging.getLogger(__name__)
+
+manifest_file_name = "repack_manifest.json"
+manifest_version = 2  # 2: layout / chunks / fill_gaps 移出缓存键，记在每个输出的 profile 里
+
+# 改变重组结果的配置项，stream / engine / workers 等只影响速度的不在其中
+frame_fields = {
+    "mimo.profile": ["numAdcSamples"],
+    "mimo.frame": ["numLoops", "framePeriodicity"],
+    "bracket.profile": ["row", "col", "offset_time", "next_line_reverse"],
+}
+# 记在清单里、不进缓存键的重组选项：layout / chunks 只改变存储方式，open_array 认得每一种；
+# fill_gaps 改变内容，但命令行给的值不会写进 config.toml，config.toml 没写时接受已有的结果，见 is_fresh
+profile_fields = ["fill_gaps", "layout", "chunks"]
+roi_fields = ["tx", "rx_devices", "rows", "cols", "stride"]
+
+
+def source_stat(input_dir: Path):
+    """Size and mtime of every file a repack reads: the raw *_idx.bin / *_data.bin files and timestamps.txt."""
+    from .capture_index import _source_stat
+
+    input_dir = Path(input_dir)
+    sources = _source_stat(input_dir)
+    stat = (input_dir / "timestamps.txt").stat()
+    sources["timestamps.txt"] = [stat.st_size, stat.st_mtime_ns]
+    return sources
+
+
+def output_config(cfg: schemas.MMWConfig, output: str):
+    """The config values an output depends on.
+
+    output is "frame" or "range_profile", or "roi_frame" / "roi_range_profile" for a partial repack.
+    """
+    from .repack import get_chirp_select, get_range_bins
+
+    config = {}
+    for section, fields in frame_fields.items():
+        model = cfg
+        for name in section.split("."):
+            model = getattr(model, name)
+        config.update({f"{section}.{field}": getattr(model, field) for field in fields})
+    chirps, mean = get_chirp_select(cfg)
+    if isinstance(chirps, slice):
+        config["chirps"] = ["mean" if mean else "all", chirps.start, chirps.stop]
+    elif chirps != min(1, cfg.mimo.frame.numLoops - 1):  # 默认的单 loop 不进入缓存键，已有的缓存仍然有效
+        config["chirps"] = chirps
+    if output.startswith("roi_"):
+        config.update({f"repack.profile.{field}": getattr(cfg.repack.profile, field) for field in roi_fields})
+    if output.endswith("range_profile"):
+        config["range_bins"] = get_range_bins(cfg).tolist()
+    return config
+
+
+def cache_key(input_dir: Path, cfg: schemas.MMWConfig, output: str, sources: dict = None):
+    """Everything an output is derived from, and its sha256."""
+    from .repack import repack_version
+
+    key = {
+        "repack_version": repack_version,
+        "config": output_config(cfg, output),
+        "sources": source_stat(input_dir) if sources is None else sources,
+    }
+    key["hash"] = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return key
+
+
+def load_manifest(input_dir: Path) -> dict:
+    manifest_path = Path(input_dir) / manifest_file_name
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != manifest_version:
+        return {}
+    return manifest.get("outputs", {})
+
+
+def write_manifest(input_dir: Path, cfg: schemas.MMWConfig, outputs: dict[str, Path]):
+    """Record the cache key of freshly written outputs, entries of other outputs are kept."""
+    input_dir = Path(input_dir)
+    entries = load_manifest(input_dir)
+    sources = source_stat(input_dir)
+    for output, path in outputs.items():
+        profile = {field: getattr(cfg.repack.profile, field) for field in profile_fields}
+        entries[output] = {"file": Path(path).name, "profile": profile, **cache_key(input_dir, cfg, output, sources)}
+
+    manifest_path = input_dir / manifest_file_name
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    try:
+        tmp_path.write_text(json.dumps({"version": manifest_version, "outputs": entries}, indent=2))
+        tmp_path.replace(manifest_path)
+    except OSError as e:
+        _logger.warning(f"can not write repack manifest: {e!r}")
+
+
+def is_fresh(input_dir: Path, cfg: schemas.MMWConfig, output: str = "frame"):
+    """The output was repacked from the current raw files with the same config and repack code.
+
+    The reason of a miss is logged, so a silent reuse or an unexpected repack can be traced.
+    """
+    from .chunked import array_exists
+
+    input_dir = Path(input_dir)
+    entry = load_manifest(input_dir).get(output)
+    if entry is None:
+        _logger.info(f"{output} has no cache entry")
+        return False
+    if not array_exists(input_dir / entry["file"]):
+        _logger.info(f"{output} cache file {entry['file']} missing")
+        return False
+    try:
+        key = cache_key(input_dir, cfg, output)
+    except FileNotFoundError as e:
+        _logger.info(f"{output} sources missing: {e}")
+        return False
+    if key["hash"] == entry["hash"]:
+        fill_gaps = cfg.repack.profile.fill_gaps
+        if fill_gaps is not None and entry.get("profile", {}).get("fill_gaps") != fill_gaps:
+            _logger.info(f"{output} cache out of date: repack.profile.fill_gaps changed")
+            return False
+        return True
+    for part in ["repack_version", "config", "sources"]:
+        if key[part] != entry.get(part):
+            changed = part
+            if isinstance(key[part], dict):
+                old = entry.get(part) or {}
+                changed = ", ".join(k for k in key[part].keys() | old.keys() if key[part].get(k) != old.get(k))
+            _logger.info(f"{output} cache out of date: {changed} changed")
+    return False
+
+
+def with_stored_profile(input_dir: Path, cfg: schemas.MMWConfig, output: str = "frame"):
+    """Fill the profile_fields cfg leaves unset (None) from the manifest entry of output, in place.
+
+    An output repacked with --layout or --fill-gaps on the command line is then written the same
+    way again when a changed source makes it stale.
+    """
+    stored = load_manifest(input_dir).get(output, {}).get("profile", {})
+    profile = cfg.repack.profile
+    for field in profile_fields:
+        if getattr(profile, field) is None and stored.get(field) is not None:
+            setattr(profile, field, stored[field])
+    return cfg
@@ -0,0 +1,192 @@
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .archive import archive_suffix, source_stat
+from .repack import devices, frame_time_to_idx, get_idx_info
+
+_logger = logging.getLogger(__name__)
+
+index_file_name = "capture_index.npz"
+index_version = 2  # 2: 去掉了没有用到的每帧字节偏移
+
+
+def _source_stat(input_dir: Path):
+    """Size and mtime of every raw file of the capture, used to tell if the index is stale.
+
+    An archived *_data.mwz reports the raw file it was made from, see archive.source_stat.
+    """
+    sources = {}
+    data_files = sorted(input_dir.glob("*_data.bin")) + sorted(input_dir.glob(f"*_data{archive_suffix}"))
+    for path in sorted(input_dir.glob("*_idx.bin")) + data_files:
+        name, stat = source_stat(path)
+        sources[name] = stat
+    return sources
+
+
+def find_gaps(frame_time: np.ndarray):
+    """Find dropped frames from the frame timestamps.
+
+    Return:
+        gap_pos: index of the frame just before each gap
+        gap_len: number of frames missing in each gap
+    """
+    if frame_time.shape[0] < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    interval = np.diff(frame_time.astype(np.int64))
+    period = np.median(interval)
+    missing = np.rint(interval / period).astype(np.int64) - 1
+    gap_pos = np.flatnonzero(missing > 0)
+    return gap_pos, missing[gap_pos]
+
+
+def estimate_skew(frame_time: np.ndarray, ref_time: np.ndarray, period_us: float):
+    """Constant timestamp offset (us) of a device against the reference device.
+
+    Every frame is matched to the nearest reference frame, the median of the differences is the
+    skew. The devices are triggered together, so the skew is assumed within half a frame period.
+
+    Return:
+        skew: frame_time - skew lines up with ref_time
+        matched: (frames,) bool, the frame has a reference frame within a quarter period after the skew
+    """
+    frame_time = frame_time.astype(np.float64)
+    ref_time = ref_time.astype(np.float64)
+    if frame_time.shape[0] == 0 or ref_time.shape[0] == 0:
+        return 0.0, np.zeros(frame_time.shape[0], dtype=bool)
+
+    def nearest_diff(t):
+        j = np.clip(np.searchsorted(ref_time, t), 1, max(ref_time.shape[0] - 1, 1))
+        before, after = t - ref_time[j - 1], t - ref_time[np.minimum(j, ref_time.shape[0] - 1)]
+        return np.where(np.abs(before) < np.abs(after), before, after)
+
+    diff = nearest_diff(frame_time)
+    skew = float(np.median(diff[np.abs(diff) <= period_us / 2])) if np.any(np.abs(diff) <= period_us / 2) else 0.0
+    matched = np.abs(nearest_diff(frame_time - skew)) <= period_us / 4
+    return skew, matched
+
+
+class CaptureIndex:
+    """Frame index of all devices of one capture, parsed once from the *_idx.bin files.
+
+    For every device it holds the frame timestamps (us), the number of frames of every idx file
+    and the dropped frame gaps. The per-file frame counts are what FrameArray addresses the data
+    files with, so frame j of a device is the frame whose timestamp is timestamps(device)[j].
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray], sources: dict):
+        self.arrays = arrays
+        self.sources = sources
+
+    def timestamps(self, device: str) -> np.ndarray:
+        return self.arrays[f"{device}_timestamp"]
+
+    def file_frames(self, device: str) -> np.ndarray:
+        return self.arrays[f"{device}_file_frames"]
+
+    def gaps(self, device: str):
+        return self.arrays[f"{device}_gap_pos"], self.arrays[f"{device}_gap_len"]
+
+    @property
+    def devices(self):
+        return [device for device in devices if f"{device}_timestamp" in self.arrays]
+
+    def align(self, offset_time: float, frame_periodicity: float, log=True) -> dict[str, np.ndarray]:
+        """Scan frame numbers of every device from its own timestamps.
+
+        The first master frame is the common time zero, the other devices are shifted by their
+        skew against master (see estimate_skew) first, so a frame dropped or inserted by one device
+        only leaves a hole in that device instead of shifting all of its later frames.
+
+        Return:
+            {device: data_idx}, see frame_time_to_idx
+        """
+        ref_device = "master" if "master" in self.devices else self.devices[0]
+        ref_time = self.timestamps(ref_device)
+        if ref_time.shape[0] == 0:
+            return {device: np.zeros(0, dtype=int) for device in self.devices}
+        ref_idx = frame_time_to_idx(ref_time, offset_time, frame_periodicity)
+
+        data_idx = {ref_device: ref_idx}
+        for device in self.devices:
+            if device == ref_device:
+                continue
+            frame_time = self.timestamps(device)
+            skew, matched = estimate_skew(frame_time, ref_time, frame_periodicity * 1000)
+            device_idx = frame_time_to_idx(frame_time.astype(np.float64) - skew, offset_time, frame_periodicity, ref_time[0])
+            data_idx[device] = device_idx
+            if log:
+                # 只在本设备或只在参考设备出现的帧
+                extra = np.setdiff1d(device_idx, ref_idx).shape[0]
+                missing = np.setdiff1d(ref_idx[ref_idx <= device_idx.max(initial=-1)], device_idx).shape[0]
+                level = logging.WARNING if extra or missing or not matched.all() else logging.INFO
+                _logger.log(
+                    level,
+                    f"{device}: skew {skew:.0f}us against {ref_device}, {missing} frames missing, {extra} extra, "
+                    f"{(~matched).sum()} unmatched",
+                )
+        return data_idx
+
+    @classmethod
+    def build(cls, input_dir: Path):
+        input_dir = Path(input_dir)
+        sources = _source_stat(input_dir)
+        arrays = {}
+        for device in devices:
+            idxs_path = sorted(input_dir.glob(f"{device}*_idx.bin"))
+            if not idxs_path:
+                continue
+            frame_info = [get_idx_info(idx_path)[1] for idx_path in idxs_path]
+            frame_info_all = np.concatenate(frame_info)
+            frame_time = frame_info_all["timestamp"]
+            gap_pos, gap_len = find_gaps(frame_time)
+            arrays[f"{device}_timestamp"] = frame_time
+            arrays[f"{device}_file_frames"] = np.asarray([i.shape[0] for i in frame_info], dtype=np.int64)
+            arrays[f"{device}_gap_pos"] = gap_pos
+            arrays[f"{device}_gap_len"] = gap_len
+        if not arrays:
+            raise FileNotFoundError(f"No index files found in {input_dir}")
+        return cls(arrays, sources)
+
+    @classmethod
+    def load(cls, index_file_path: Path):
+        with np.load(index_file_path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            arrays = {name: npz[name] for name in npz.files if name != "meta"}
+        if meta.get("version") != index_version:
+            raise ValueError(f"capture index version {meta.get('version')} != {index_version}")
+        return cls(arrays, meta["sources"])
+
+    def save(self, index_file_path: Path):
+        index_file_path = Path(index_file_path)
+        meta = json.dumps({"version": index_version, "sources": self.sources})
+        tmp_path = index_file_path.with_name(index_file_path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            np.savez(f, meta=np.asarray(meta), **self.arrays)
+        tmp_path.replace(index_file_path)
+
+    def is_fresh(self, input_dir: Path):
+        return self.sources == _source_stat(Path(input_dir))
+
+
+def load_capture_index(input_dir: Path, rebuild=False) -> CaptureIndex:
+    """Load the capture index sidecar, rebuilding it if it is missing or older than the raw files."""
+    input_dir = Path(input_dir)
+    index_file_path = input_dir / index_file_name
+    if index_file_path.exists() and not rebuild:
+        try:
+            index = CaptureIndex.load(index_file_path)
+            if index.is_fresh(input_dir):
+                return index
+            _logger.info("capture index out of date, rebuild")
+        except Exception as e:
+            _logger.warning(f"capture index unreadable, rebuild: {e!r}")
+
+    index = CaptureIndex.build(input_dir)
+    try:
+        index.save(index_file_path)
+    except OSError as e:  # 只读的采集目录也能用，只是不缓存
+        _logger.warning(f"can not write capture index: {e!r}")
+    return index
@@ -0,0 +1,248 @@
+import json
+import shutil
+import itertools
+from pathlib import Path
+
+import numpy as np
+
+chunked_version = 1
+manifest_name = "manifest.json"
+chunks_name = "chunks.npy"
+
+# chirp_mode all 时两者的 col 之后都多一个 "chirp" 轴
+cube_axes = ("rx", "tx", "row", "col", "sample", "iq")  # all_mmw_array.npy
+profile_axes = ("rx", "tx", "row", "col", "bin")  # range_profile.npy
+
+# 常用访问方式对应的存储轴顺序和块大小，None 表示整个轴放进一个块
+layouts = {
+    # 单通道成像: 固定 rx, tx 读整幅 row x col
+    "channel": (
+        ("rx", "tx", "chirp", "row", "col", "sample", "bin", "iq"),
+        {"rx": 1, "tx": 1, "chirp": 1, "row": 32, "col": 32},
+    ),
+    # 单距离单元的全部通道: 固定 sample/bin 读所有 rx, tx, row, col
+    "range": (
+        ("sample", "bin", "chirp", "rx", "tx", "row", "col", "iq"),
+        {"sample": 1, "bin": 1, "chirp": 1, "row": 32, "col": 32},
+    ),
+    # 单像素的全部通道和距离向
+    "pixel": (("row", "col", "rx", "tx", "chirp", "sample", "bin", "iq"), {"row": 8, "col": 8}),
+}
+
+
+def chunked_path(npy_path: Path):
+    """Directory of the chunked store that replaces the flat .npy file."""
+    npy_path = Path(npy_path)
+    return npy_path.with_name(npy_path.stem + ".chunks")
+
+
+def get_layout(layout: str, axes: tuple, chunks: dict = None):
+    """Resolve a layout preset for the given axes into (storage order, chunk shape in storage order)."""
+    order, preset_chunks = layouts[layout]
+    order = tuple(axis for axis in order if axis in axes)
+    preset_chunks = {**preset_chunks, **(chunks or {})}
+    return order, preset_chunks
+
+
+class ChunkedArray:
+    """Read only array stored as fixed size chunks in a single memmapped .npy file.
+
+    The chunks file has shape (*grid, *chunk) in storage axis order, so every chunk is one
+    contiguous run of bytes and chunks that only differ in their last grid index are adjacent.
+    Indexing uses the logical axis order and supports ints, slices and Ellipsis, only the chunks
+    touched by the index are read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        manifest = json.loads((self.path / manifest_name).read_text())
+        if manifest["version"] != chunked_version:
+            raise ValueError(f"chunked array version {manifest['version']} != {chunked_version}")
+        self.manifest = manifest
+        self.shape = tuple(manifest["shape"])
+        self.axes = tuple(manifest["axes"])
+        self.order = tuple(manifest["order"])
+        self.chunks = tuple(manifest["chunks"])
+        self.dtype = np.dtype(manifest["dtype"])
+        self.ndim = len(self.shape)
+        self.perm = [self.axes.index(axis) for axis in self.order]  # storage axis -> logical axis
+        self.data: np.memmap = np.load(self.path / chunks_name, mmap_mode="r")
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(i is Ellipsis for i in key):
+            e = key.index(Ellipsis)
+            key = key[:e] + (slice(None),) * (self.ndim - len(key) + 1) + key[e + 1 :]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError(f"too many indices for array with {self.ndim} dimensions")
+        for i in key:
+            if not isinstance(i, (int, np.integer, slice)):
+                raise IndexError("ChunkedArray only supports int, slice and Ellipsis indexes")
+        return key
+
+    def __getitem__(self, key) -> np.ndarray:
+        key = self._normalize_key(key)
+
+        grid_slices, local_idx = [], []
+        for axis, c in zip(self.perm, self.chunks):
+            n, i = self.shape[axis], key[axis]
+            idx = np.arange(n)[i]
+            if idx.size == 0:
+                shape = np.broadcast_to(np.empty((), dtype=np.uint8), self.shape)[key].shape
+                return np.empty(shape, dtype=self.dtype)
+            g0, g1 = idx.min() // c, idx.max() // c + 1
+            grid_slices.append(slice(g0, g1))
+            local_idx.append(idx - g0 * c)
+
+        block = self.data[tuple(grid_slices)]  # (*grid, *chunk)
+        nd = self.ndim
+        block = block.transpose(list(itertools.chain.from_iterable((i, i + nd) for i in range(nd))))
+        block = block.reshape([block.shape[2 * i] * block.shape[2 * i + 1] for i in range(nd)])
+        block = block[np.ix_(*[np.atleast_1d(i) for i in local_idx])]
+
+        block = block.transpose(np.argsort(self.perm))  # storage order -> logical order
+        squeeze = tuple(axis for axis in range(nd) if isinstance(key[axis], (int, np.integer)))
+        return block.squeeze(axis=squeeze) if squeeze else block
+
+    @classmethod
+    def from_array(cls, array: np.ndarray, path: Path, axes: tuple, order: tuple, chunks: dict, block_bytes: int = 256 * 2**20):
+        """Write array into a chunked store at path.
+
+        The source is read once, in blocks that are contiguous in its own (C) order, and every block
+        is scattered into the chunks it covers, see _source_blocks and _chunk_runs. Memory stays
+        bounded by one block of block_bytes plus the dirty pages of the chunks file the kernel is
+        writing back, so cubes larger than RAM convert without re-reading the source per chunk.
+        """
+        path = Path(path)
+        if path.exists():
+            shutil.rmtree(path)
+        path.mkdir(parents=True)
+
+        perm = [axes.index(axis) for axis in order]
+        shape = [array.shape[i] for i in perm]
+        chunk_shape = [min(chunks.get(axis) or n, n) for axis, n in zip(order, shape)]
+        grid = [-(-n // c) for n, c in zip(shape, chunk_shape)]
+        data = np.lib.format.open_memmap(path / chunks_name, mode="w+", dtype=array.dtype, shape=(*grid, *chunk_shape))
+
+        # 末尾顺序不变、也不分块的轴（如 iq）合成一个元素，转置时按元素整体搬
+        nd = len(shape)
+        while nd > 0 and perm[nd - 1] == nd - 1 and chunk_shape[nd - 1] == shape[nd - 1]:
+            nd -= 1
+        unit = np.dtype((np.void, array.dtype.itemsize * int(np.prod(shape[nd:], dtype=np.int64))))
+        store = data.reshape(*grid[:nd], *chunk_shape[:nd], -1).view(unit)[..., 0]
+
+        interleave = list(itertools.chain.from_iterable((i, i + nd) for i in range(nd)))  # (*grid, *chunk) -> (g0, c0, ...)
+        source_chunks = [chunk_shape[perm.index(i)] for i in range(nd)]
+        for block_index in _source_blocks(array.shape[:nd], unit.itemsize, source_chunks, block_bytes):
+            block = np.ascontiguousarray(array[block_index])  # 顺序读一次
+            block = block.reshape(*block.shape[:nd], -1).view(unit)[..., 0].transpose(perm[:nd])
+            starts = [block_index[i].start for i in perm[:nd]]
+            runs = [_chunk_runs(a, a + n, c) for a, n, c in zip(starts, block.shape, chunk_shape)]
+            for piece in itertools.product(*runs):
+                src, dst, split = [], [], []
+                for (s, e), a, c in zip(piece, starts, chunk_shape):
+                    src.append(slice(s - a, e - a))
+                    if s % c == 0 and (e - s) % c == 0:  # 整块
+                        dst.append((slice(s // c, e // c), slice(0, c)))
+                        split.extend(((e - s) // c, c))
+                    else:  # 落在一个块内
+                        dst.append((slice(s // c, s // c + 1), slice(s % c, s % c + e - s)))
+                        split.extend((1, e - s))
+                target = store[tuple(g for g, _ in dst) + tuple(l for _, l in dst)].transpose(interleave)
+                target[...] = block[tuple(src)].reshape(split)  # 只拆分轴，两边都是视图，一次拷贝
+        data.flush()
+        del data
+
+        manifest = {
+            "version": chunked_version,
+            "shape": list(array.shape),
+            "dtype": np.dtype(array.dtype).str,
+            "axes": list(axes),
+            "order": list(order),
+            "chunks": chunk_shape,
+            "grid": grid,
+        }
+        (path / manifest_name).write_text(json.dumps(manifest, indent=2))
+        return cls(path)
+
+
+def _source_blocks(shape: tuple, itemsize: int, chunks: list, block_bytes: int):
+    """Index tuples of contiguous blocks of a C ordered array, each at most block_bytes (or one row of the last axis).
+
+    The first axis k whose single index fits in block_bytes is stepped through, the axes before it
+    one index at a time. The step along k is a multiple of its chunk size when it is larger, so a
+    block covers whole chunks there.
+    """
+    nd = len(shape)
+    inner = [int(np.prod(shape[i + 1 :], dtype=np.int64)) * itemsize for i in range(nd)]
+    k = next((i for i in range(nd) if inner[i] <= block_bytes), nd - 1)
+    step = max(1, block_bytes // inner[k])
+    if step >= chunks[k]:
+        step -= step % chunks[k]
+    for outer in itertools.product(*[range(n) for n in shape[:k]]):
+        for start in range(0, shape[k], step):
+            index = tuple(slice(i, i + 1) for i in outer) + (slice(start, min(start + step, shape[k])),)
+            yield index + tuple(slice(0, n) for n in shape[k + 1 :])
+
+
+def _chunk_runs(a: int, b: int, c: int):
+    """Split [a, b) into runs that either lie inside one chunk of size c or cover whole chunks."""
+    runs = []
+    head = min(b, -(-a // c) * c)
+    if head > a:
+        runs.append((a, head))
+    mid = head + (b - head) // c * c
+    if mid > head:
+        runs.append((head, mid))
+    if b > mid:
+        runs.append((mid, b))
+    return runs
+
+
+def to_chunked(npy_path: Path, axes: tuple, layout: str, chunks: dict = None, remove=True):
+    """Convert a repacked .npy file into a chunked store next to it, see chunked_path."""
+    npy_path = Path(npy_path)
+    order, chunks = get_layout(layout, axes, chunks)
+    array = np.load(npy_path, mmap_mode="r")
+    path = chunked_path(npy_path)
+    tmp_path = path.with_name(path.name + ".part")
+    ChunkedArray.from_array(array, tmp_path, axes, order, chunks)
+    del array
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+    if remove:
+        npy_path.unlink()
+    return ChunkedArray(path)
+
+
+def apply_layout(npy_path: Path, axes: tuple, layout: str = None, chunks: dict = None):
+    """Store a freshly repacked .npy in the given layout, None keeps the flat file.
+
+    A chunked store left over from an earlier repack is removed so it never shadows new data.
+    """
+    if layout:
+        return to_chunked(npy_path, axes, layout, chunks)
+    path = chunked_path(npy_path)
+    if path.exists():
+        shutil.rmtree(path)
+
+
+def open_array(npy_path: Path):
+    """Open a repacked array, preferring its chunked store over the flat .npy memmap."""
+    path = chunked_path(npy_path)
+    if (path / manifest_name).exists():
+        return ChunkedArray(path)
+    return np.load(npy_path, mmap_mode="r")
+
+
+def array_exists(npy_path: Path):
+    return Path(npy_path).exists() or (chunked_path(npy_path) / manifest_name).exists()
@@ -0,0 +1,84 @@
+import os
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+import scipy.fft
+
+_logger = logging.getLogger(__name__)
+
+# scipy.fft 的 pocketfft 自己缓存最近用过的计划，workers 把批量 FFT 分到多个线程
+backends = {"numpy": np.fft, "scipy": scipy.fft}
+try:  # 可选依赖，FFTW 的计划更快，多线程也对单个大 FFT 有效
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+
+    pyfftw.interfaces.cache.enable()  # 保留最近用过的 FFTW 计划，相同形状的 FFT 不再重新规划
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    backends["pyfftw"] = pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
+precisions = {"single": np.complex64, "double": np.complex128}
+
+settings = {
+    "backend": "pyfftw" if "pyfftw" in backends else "scipy",
+    "workers": os.cpu_count() or 1,
+    "precision": None,  # None 保持输入的精度，complex64 进 complex64 出
+}
+
+
+def set_fft(backend: str = None, workers: int = None, precision: str = None):
+    """Change the FFT backend, its threads or the precision for every later call.
+
+    Arguments:
+        backend: "scipy", "numpy" or "pyfftw" (needs pyFFTW installed)
+        workers: threads per FFT call, -1 for all cores, numpy always uses one
+        precision: "single" / "double" to cast the input, "input" to keep its precision
+    """
+    if backend is not None:
+        if backend not in backends:
+            raise ValueError(f"FFT backend {backend} is not available, choose from {list(backends)}")
+        settings["backend"] = backend
+    if workers is not None:
+        settings["workers"] = (os.cpu_count() or 1) if workers == -1 else workers
+    if precision is not None:
+        if precision != "input" and precision not in precisions:
+            raise ValueError(f"precision must be one of {[*precisions, 'input']}, got {precision}")
+        settings["precision"] = None if precision == "input" else precision
+
+
+@contextmanager
+def fft_settings(**kwargs):
+    """set_fft inside a with block only."""
+    old = dict(settings)
+    set_fft(**kwargs)
+    try:
+        yield settings
+    finally:
+        settings.update(old)
+
+
+def _call(name: str, a, workers: int = None, **kwargs):
+    a = np.asarray(a)
+    if settings["precision"] is not None:
+        a = a.astype(precisions[settings["precision"]], copy=False)
+    if settings["backend"] != "numpy":
+        kwargs["workers"] = workers or settings["workers"]
+    return getattr(backends[settings["backend"]], name)(a, **kwargs)
+
+
+def fft(a, n: int = None, axis: int = -1, workers: int = None):
+    """np.fft.fft on the configured backend, workers overrides the global threads (e.g. 1 inside a worker pool)."""
+    return _call("fft", a, workers, n=n, axis=axis)
+
+
+def ifft(a, n: int = None, axis: int = -1, workers: int = None):
+    return _call("ifft", a, workers, n=n, axis=axis)
+
+
+def fft2(a, s=None, axes=(-2, -1), workers: int = None):
+    return _call("fft2", a, workers, s=s, axes=axes)
+
+
+def ifft2(a, s=None, axes=(-2, -1), workers: int = None):
+    return _call("ifft2", a, workers, s=s, axes=axes)
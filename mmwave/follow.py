@@ -0,0 +1,158 @@
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from . import schemas
+from .capture_index import CaptureIndex, load_capture_index
+from .repack import (
+    MMWFrame,
+    RepackROI,
+    devices,
+    finish_outputs,
+    get_chirp_select,
+    get_data_files_path,
+    get_devices_valid_mask,
+    get_range_bins,
+    get_repack_outputs,
+    line_time_to_idx,
+    rx_tabel,
+    save_valid_mask,
+    turn_device_frame,
+)
+
+_logger = logging.getLogger(__name__)
+
+
+def read_scan_lines(timestamps_path: Path):
+    """Read the scan lines finished so far from a timestamps.txt that may still be growing.
+
+    Return:
+        (line, 2) start and end time in s of every finished line
+        finished: the trailing (time_offset, 0) row is there, the scan is over
+    """
+    if not timestamps_path.exists():
+        return np.zeros((0, 2)), False
+    try:
+        time_info = np.loadtxt(timestamps_path, ndmin=2)
+    except ValueError:  # 正在写入的半行
+        text = timestamps_path.read_text().rsplit("\n", 1)[0]
+        time_info = np.loadtxt(text.splitlines(), ndmin=2)
+    if time_info.size == 0:
+        return np.zeros((0, 2)), False
+    finished = time_info[-1, 1] == 0
+    return (time_info[:-1] if finished else time_info), finished
+
+
+def follow_frame(input_dir: Path, cfg: schemas.MMWConfig, poll_interval: float = 1.0, idle_timeout: float = 60.0):
+    """Repack a capture while it is being recorded.
+
+    Every poll re-reads the idx files and timestamps.txt, and each scan line that is finished
+    (its end time is in timestamps.txt and every device already has frames past its end) is
+    written into the stream output. When the trailing time offset row shows up, or nothing
+    grew for idle_timeout seconds, the remaining lines are written and the outputs finished
+    exactly like turn_frame does.
+    """
+    input_dir = Path(input_dir)
+    chrips_num = cfg.mimo.frame.numLoops
+    chirp_idx, chirp_mean = get_chirp_select(cfg)
+    samples_num = cfg.mimo.profile.numAdcSamples
+    frame_periodicity = cfg.mimo.frame.framePeriodicity
+    offset_time = cfg.bracket.profile.offset_time
+    x_sample_num = cfg.bracket.profile.col
+    y_sample_num = cfg.bracket.profile.row
+    next_line_reverse = cfg.bracket.profile.next_line_reverse
+    range_bins = get_range_bins(cfg) if cfg.repack.profile.range_fft else None
+    if not RepackROI(cfg).full:
+        raise ValueError("follow mode always repacks the full cube, drop the roi options")
+
+    outputs = get_repack_outputs(input_dir, cfg, stream=True, engine="thread")
+    try:
+        all_frames = outputs["frame"].array if "frame" in outputs else None
+        range_profile = outputs["range_profile"].array if "range_profile" in outputs else None
+
+        done_lines = 0
+        last_change, last_state = time.monotonic(), None
+        while True:
+            time_info, finished = read_scan_lines(input_dir / "timestamps.txt")
+            time_info = time_info[:y_sample_num]
+            bracket_idx = line_time_to_idx(time_info, x_sample_num, frame_periodicity)
+
+            try:
+                index = CaptureIndex.build(input_dir)
+            except FileNotFoundError:
+                index = None
+
+            state = (time_info.shape[0], index and tuple(index.timestamps(i).shape[0] for i in index.devices))
+            if state != last_state:
+                last_change, last_state = time.monotonic(), state
+            idle = time.monotonic() - last_change > idle_timeout
+            final = finished or idle or (time_info.shape[0] >= y_sample_num and done_lines >= y_sample_num)
+
+            has_master = index is not None and "master" in index.devices and index.timestamps("master").shape[0]
+            if has_master and bracket_idx.shape[0] > done_lines:
+                data_idx = index.align(offset_time, frame_periodicity, log=False)
+                mmw_frames = {}
+                ready_lines = bracket_idx.shape[0]
+                for device_name in devices:
+                    try:
+                        bin_files_path, _ = get_data_files_path(input_dir, device_name)
+                    except (FileNotFoundError, ValueError):  # 设备的数据文件还没有创建
+                        if final:
+                            raise
+                        ready_lines = done_lines
+                        break
+                    if device_name not in data_idx:
+                        if final:
+                            raise FileNotFoundError(f"No index files of {device_name} found in {input_dir}")
+                        ready_lines = done_lines
+                        break
+                    device_idx = data_idx[device_name]
+                    mmw_frames[device_name] = MMWFrame(
+                        bin_files_path, samples_num, chrips_num, device_idx, index.file_frames(device_name), partial=True
+                    )
+                    if not final:  # 只处理所有设备都已经写过行尾的扫描线
+                        last_idx = mmw_frames[device_name].data_idx[-1] if len(mmw_frames[device_name].data_idx) else -1
+                        ready_lines = min(ready_lines, int(np.searchsorted(bracket_idx[:, 1], last_idx, side="right")))
+
+                if ready_lines > done_lines:
+                    lines = range(done_lines, ready_lines)
+                    for device_name, mmw_frame in mmw_frames.items():
+                        turn_device_frame(
+                            all_frames,
+                            mmw_frame,
+                            rx_tabel[device_name],
+                            chirp_idx,
+                            bracket_idx,
+                            next_line_reverse,
+                            cfg.repack.profile.line_buffer,
+                            lines,
+                            range_profile,
+                            range_bins,
+                            None,
+                            chirp_mean,
+                        )
+                    _logger.info(f"lines {done_lines}:{ready_lines} of {y_sample_num} repacked")
+                    done_lines = ready_lines
+
+            if final:
+                if idle and not finished:
+                    _logger.warning(f"capture stopped growing for {idle_timeout}s, finish with {done_lines} lines")
+                break
+            time.sleep(poll_interval)
+
+        index = load_capture_index(input_dir)
+        data_idx = index.align(offset_time, frame_periodicity)
+        file_frames = {device: index.file_frames(device) for device in index.devices}
+        mask = np.zeros((len(devices), y_sample_num, x_sample_num), dtype=bool)
+        if bracket_idx.shape[0]:
+            mask[:, : bracket_idx.shape[0]] = get_devices_valid_mask(
+                input_dir, cfg, data_idx, file_frames, bracket_idx, partial=True
+            )
+        save_valid_mask(input_dir / "valid_mask.npz", mask)
+        all_frames = range_profile = None
+        finish_outputs(outputs, cfg, mask)
+    finally:
+        for output in outputs.values():
+            output.close()
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+def gap_index(mask: np.ndarray):
+    """Neighbours used to fill the missing positions along the last axis of a validity mask.
+
+    Return:
+        left, right: nearest valid position on each side, at the edges both are the single nearest one
+        weight: linear weight of right, float32
+        fillable: missing positions with at least one valid neighbour
+    """
+    n = mask.shape[-1]
+    pos = np.arange(n)
+    left = np.maximum.accumulate(np.where(mask, pos, -1), axis=-1)
+    right = np.minimum.accumulate(np.where(mask, pos, n)[..., ::-1], axis=-1)[..., ::-1]
+    left_ok, right_ok = left >= 0, right < n
+
+    # 扫描线两端只有一侧有数据，直接取最近的有效点
+    left, right = np.where(left_ok, left, right), np.where(right_ok, right, left)
+    span = right - left
+    weight = np.where(span > 0, (pos - left) / np.maximum(span, 1), 0).astype(np.float32)
+    fillable = ~mask & (left_ok | right_ok)
+    return np.clip(left, 0, n - 1), np.clip(right, 0, n - 1), weight, fillable
+
+
+def interp_gap(a: np.ndarray, b: np.ndarray, weight: np.ndarray, method="linear"):
+    """Interpolate between the neighbours a and b.
+
+    linear: a + w (b - a)
+    phase: magnitude linear, phase rotated along the shortest arc from a to b, keeps the
+        phase history of complex echoes instead of shrinking them towards zero.
+    """
+    if method == "linear":
+        return a + weight * (b - a)
+    if method == "phase":
+        if not np.iscomplexobj(a):
+            raise ValueError("phase interpolation needs complex data")
+        mag = np.abs(a) + weight * (np.abs(b) - np.abs(a))
+        phase = np.angle(a) + weight * np.angle(b * np.conj(a))
+        return (mag * np.exp(1j * phase)).astype(a.dtype, copy=False)
+    raise ValueError(f"unknown gap fill method {method}")
+
+
+def fill_line_gaps(lines: np.ndarray, mask: np.ndarray, method="linear", iq=False):
+    """Fill the missing positions of lines along the scan axis.
+
+    Arguments:
+        lines: (..., col, *tail) data, the col axis is the last axis of mask
+        mask: (..., col) bool, True where a real frame was recorded, broadcast over the leading axes
+        method: linear or phase
+        iq: the last axis of lines holds int I/Q pairs
+    Return:
+        A new array shaped and typed like lines
+    """
+    left, right, weight, fillable = gap_index(mask)
+    if not fillable.any():
+        return lines
+
+    values = lines
+    if iq:
+        values = np.empty(lines.shape[:-1], dtype=np.complex64)
+        values.real, values.imag = lines[..., 0], lines[..., 1]
+    col_axis = mask.ndim - 1
+    ex = (...,) + (None,) * (values.ndim - mask.ndim)
+    a = np.take_along_axis(values, left[ex], axis=col_axis)
+    b = np.take_along_axis(values, right[ex], axis=col_axis)
+    filled = np.where(fillable[ex], interp_gap(a, b, weight[ex], method), values)
+
+    if iq:
+        filled = np.stack((filled.real, filled.imag), axis=-1)
+    if np.issubdtype(lines.dtype, np.integer):
+        filled = np.rint(filled)
+    return filled.astype(lines.dtype, copy=False)
+
+
+def fill_gaps(data: np.ndarray, rx_mask: np.ndarray, method="linear", block_rows: int = 8):
+    """Fill missing frames of a repacked array in place, block by block.
+
+    Arguments:
+        data: (16, 12, row, col, samples, 2) int16 cube or (16, 12, row, col, bins) complex profile,
+            usually a memmap opened with mode r+
+        rx_mask: (16, row, col) validity mask, see repack.load_valid_mask
+        block_rows: scan lines read per block, bounds the memory used
+    """
+    iq = not np.iscomplexobj(data)
+    rx_num, _, row = data.shape[:3]
+    for rx in range(rx_num):
+        for r0 in range(0, row, block_rows):
+            mask = rx_mask[rx, r0 : r0 + block_rows]
+            if mask.all() or not mask.any():
+                continue
+            block = np.asarray(data[rx, :, r0 : r0 + block_rows])
+            data[rx, :, r0 : r0 + block_rows] = fill_line_gaps(block, mask[np.newaxis], method, iq)
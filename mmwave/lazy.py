@@ -0,0 +1,337 @@
+import logging
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+from .chunked import ChunkedArray
+from .fft_backend import fft
+
+_logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """LRU of computed CaptureArray results, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes: int = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            result = self._items.get(key)
+            if result is not None:
+                self._items.move_to_end(key)
+            return result
+
+    def put(self, key: tuple, result: np.ndarray):
+        if result.nbytes > self.max_bytes:
+            return
+        result.setflags(write=False)  # 缓存的结果被共享，不能原地修改
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = result
+            self.nbytes += result.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+def _index_key(index):
+    return index if np.ndim(index) == 0 else index.tobytes()
+
+
+def read_orthogonal(source, index: list):
+    """source[index] with every axis indexed on its own, like np.ix_.
+
+    index holds an int or a 1-D int array per axis. Arrays with a regular step are read as slices,
+    others as the bounding slice followed by a take, so both memmaps and ChunkedArray only read
+    the part that is needed.
+    """
+    key, takes = [], []
+    for idx in index:
+        if np.ndim(idx) == 0:
+            key.append(int(idx))
+            continue
+        if idx.shape[0] == 0:
+            key.append(slice(0, 0))
+            continue
+        step = int(idx[1] - idx[0]) if idx.shape[0] > 1 else 1
+        if step > 0 and np.array_equal(idx, idx[0] + step * np.arange(idx.shape[0])):
+            key.append(slice(int(idx[0]), int(idx[-1]) + 1, step))
+        else:
+            start = int(idx.min())
+            key.append(slice(start, int(idx.max()) + 1))
+            takes.append((len(key) - 1, idx - start))
+    data = np.asarray(source[tuple(key)])
+    for axis, idx in takes:
+        axis -= sum(1 for k in key[:axis] if isinstance(k, int))  # int 索引的轴已经去掉
+        data = np.take(data, idx, axis=axis)
+    return data
+
+
+class CaptureArray(NDArrayOperatorsMixin):
+    """Lazy view over a repacked cube, see util.load_frame.
+
+    Indexing, to_complex, range_fft and calibrate only record what to do. Every axis is indexed on
+    its own (ints, slices, int lists / arrays, Ellipsis). The work runs in compute, one block of
+    scan rows at a time, so a block is all that is ever held besides the result. iter_chunks
+    yields the blocks one by one instead, for reductions over a full cube.
+
+    numpy functions and operators compute the array first, so existing code such as
+    frame[rx, tx, ..., 0] + 1j * frame[rx, tx, ..., 1] keeps working.
+
+    Arguments:
+        source: the repacked cube, a .npy memmap or a ChunkedArray
+        axes: name of every source axis, see chunked.cube_axes
+        cache: ResultCache shared by all arrays derived from this one
+        chunk_bytes: target size of one block of work
+    """
+
+    def __init__(self, source, axes: tuple, cache: ResultCache = None, chunk_bytes: int = 64 * 2**20):
+        self.source = source
+        self.source_axes = tuple(axes)
+        self.index = {axis: np.arange(n) for axis, n in zip(self.source_axes, source.shape)}
+        self.ops: tuple = ()
+        self.bins = None  # range_fft 之后对距离单元的选取
+        self.cache = ResultCache() if cache is None else cache
+        self.chunk_bytes = chunk_bytes
+        self._pages = source.data if isinstance(source, ChunkedArray) else source  # 读完一块后释放的 memmap
+
+    def _derive(self, index: dict = None, ops: tuple = None, bins=None):
+        array = object.__new__(CaptureArray)
+        array.__dict__.update(self.__dict__)
+        array.index = dict(self.index if index is None else index)
+        array.ops = self.ops if ops is None else ops
+        array.bins = self.bins if bins is None else bins
+        return array
+
+    def _op_names(self):
+        return [op[0] for op in self.ops]
+
+    @property
+    def axes(self) -> tuple:
+        axes = []
+        for axis in self.source_axes:
+            if np.ndim(self.index[axis]) == 0 or (axis == "iq" and "complex" in self._op_names()):
+                continue
+            if axis == "sample" and "fft" in self._op_names():
+                if np.ndim(self.bins) == 0:
+                    continue
+                axis = "bin"
+            axes.append(axis)
+        return tuple(axes)
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self.bins.shape[0] if axis == "bin" else self.index[axis].shape[0] for axis in self.axes)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.complex64) if "complex" in self._op_names() else np.dtype(self.source.dtype)
+
+    @property
+    def ndim(self):
+        return len(self.axes)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        ops = ", ".join(self._op_names()) or "none"
+        return f"CaptureArray(shape={self.shape}, dtype={self.dtype}, axes={self.axes}, ops=[{ops}])"
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        axes = self.axes
+        if any(k is Ellipsis for k in key):
+            e = key.index(Ellipsis)
+            key = key[:e] + (slice(None),) * (len(axes) - len(key) + 1) + key[e + 1 :]
+        if len(key) > len(axes):
+            raise IndexError(f"too many indices for CaptureArray with {len(axes)} dimensions")
+
+        index, bins = dict(self.index), self.bins
+        for axis, k in zip(axes, key):
+            if isinstance(k, (list, tuple)):
+                k = np.asarray(k)
+            if isinstance(k, np.ndarray) and k.ndim != 1:
+                raise IndexError("CaptureArray indexes every axis on its own, use 1-D index arrays")
+            if axis == "bin":
+                bins = bins[k]
+            else:
+                index[axis] = index[axis][k]
+        return self._derive(index, bins=bins)
+
+    def to_complex(self):
+        """I + jQ as complex64, the iq axis is dropped."""
+        if "iq" not in self.axes or not np.array_equal(self.index["iq"], [0, 1]):
+            raise ValueError("to_complex needs the whole iq axis")
+        return self._derive(ops=(*self.ops, ("complex",)))
+
+    def range_fft(self, window: np.ndarray | str = None):
+        """FFT over the ADC samples, the sample axis becomes the range bin axis.
+
+        window: taper applied to the samples first, an array or a scipy.signal.get_window name
+        """
+        if "complex" not in self._op_names():
+            raise ValueError("call to_complex before range_fft")
+        samples_num = self.source.shape[self.source_axes.index("sample")]
+        if "sample" not in self.axes or not np.array_equal(self.index["sample"], np.arange(samples_num)):
+            raise ValueError("range_fft needs every ADC sample")
+        if isinstance(window, str):
+            from scipy.signal import get_window
+
+            window = get_window(window, samples_num)
+        if window is not None:
+            window = np.asarray(window, dtype=np.float32)
+        return self._derive(ops=(*self.ops, ("fft", window)), bins=np.arange(samples_num))
+
+    def calibrate(self, weights: np.ndarray):
+        """Multiply every channel by its complex calibration weight.
+
+        weights: (16 rx, 12 tx) of the full cube, the selected channels are picked from it
+        """
+        if "complex" not in self._op_names():
+            raise ValueError("call to_complex before calibrate")
+        weights = np.asarray(weights, dtype=np.complex64)
+        if weights.shape != (self.source.shape[0], self.source.shape[1]):
+            raise ValueError(f"calibration weights must be (rx, tx) {self.source.shape[:2]}, got {weights.shape}")
+        return self._derive(ops=(*self.ops, ("calibrate", weights)))
+
+    def signature(self) -> tuple:
+        """Hashable description of the result, the key of the result cache."""
+        ops = []
+        for op in self.ops:
+            ops.append((op[0], *(None if arg is None else arg.tobytes() for arg in op[1:])))
+        bins = None if self.bins is None else _index_key(self.bins)
+        return tuple(_index_key(self.index[axis]) for axis in self.source_axes) + (tuple(ops), bins)
+
+    def _compute_block(self, index: dict, fft_workers: int = None) -> np.ndarray:
+        data = read_orthogonal(self.source, [index[axis] for axis in self.source_axes])
+        axes = [axis for axis in self.source_axes if np.ndim(index[axis]) != 0]
+        for op in self.ops:
+            if op[0] == "complex":
+                iq = axes.index("iq")
+                echo = np.empty(data.shape[:iq] + data.shape[iq + 1 :], dtype=np.complex64)
+                echo.real = np.take(data, 0, axis=iq)
+                echo.imag = np.take(data, 1, axis=iq)
+                data = echo
+                axes.pop(iq)
+            elif op[0] == "fft":
+                s = axes.index("sample")
+                if op[1] is not None:
+                    data = data * op[1].reshape((-1,) + (1,) * (data.ndim - s - 1))
+                data = fft(data, axis=s, workers=fft_workers)
+                data = np.take(data, self.bins, axis=s).astype(np.complex64, copy=False)
+                if np.ndim(self.bins) == 0:
+                    axes.pop(s)
+                else:
+                    axes[s] = "bin"
+            elif op[0] == "calibrate":
+                weights = op[1][index["rx"]][..., index["tx"]]  # rx, tx 是最前面两个轴
+                data = data * weights.reshape(weights.shape + (1,) * (data.ndim - weights.ndim))
+        return data
+
+    def _blocks(self, workers: int = 1):
+        """(output key, source index) of every block of work, split along row, then col if a row is too big.
+
+        The blocks of parallel workers share chunk_bytes, so the memory in flight stays the same.
+        """
+        axes = self.axes
+        # 按读入的数据估计，int16 转 complex64 再 FFT，峰值约为读入字节数的 5 倍
+        read_bytes = np.prod([np.size(i) for i in self.index.values()]) * np.dtype(self.source.dtype).itemsize
+        work_bytes = read_bytes * (5 if self.ops else 1)
+        parts_left = max(1, int(np.ceil(work_bytes / max(1, self.chunk_bytes // max(workers, 1)))))
+
+        blocks = [((slice(None),) * len(axes), dict(self.index))]
+        for split in ("row", "col"):
+            if split not in axes or parts_left <= 1:
+                continue
+            n = self.index[split].shape[0]
+            parts = min(n, parts_left)
+            step = int(np.ceil(n / parts))
+            parts_left = int(np.ceil(parts_left / parts))
+            pos = axes.index(split)
+            split_blocks = []
+            for key, index in blocks:
+                for start in range(0, n, step):
+                    sub = dict(index)
+                    sub[split] = self.index[split][start : start + step]
+                    split_blocks.append((key[:pos] + (slice(start, start + step),) + key[pos + 1 :], sub))
+            blocks = split_blocks
+        return blocks
+
+    def iter_chunks(self):
+        """Yield (output key, block) one block at a time, result[key] = block."""
+        from .repack import release_pages
+
+        for key, index in self._blocks():
+            yield key, self._compute_block(index)
+            release_pages(self._pages)
+
+    def compute(self, workers: int = None, out: np.ndarray = None, cache=True) -> np.ndarray:
+        """Run the deferred operations block by block.
+
+        Arguments:
+            workers: blocks computed in parallel threads, numpy reads and FFTs release the GIL
+            out: array (e.g. an open_memmap) to write into instead of a new one
+            cache: look up / store the result in the result cache, cached results are read only
+        Return:
+            the result array, out if given
+        """
+        from .repack import release_pages
+
+        key = self.signature()
+        cached = self.cache.get(key) if cache else None
+        if cached is not None:
+            if out is None:
+                return cached
+            out[...] = cached
+            return out
+
+        result = np.empty(self.shape, dtype=self.dtype) if out is None else out
+        if result.shape != self.shape:
+            raise ValueError(f"out has shape {result.shape}, expected {self.shape}")
+
+        def run(block):
+            block_key, index = block
+            result[block_key] = self._compute_block(index, fft_workers)
+            release_pages(self._pages)
+
+        blocks = self._blocks(workers or 1)
+        fft_workers = 1 if workers and workers > 1 else None  # 块已经并行，FFT 不再开线程
+        if workers and workers > 1 and len(blocks) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(run, blocks))
+        else:
+            for block in blocks:
+                run(block)
+        if cache and out is None:
+            self.cache.put(key, result)
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.compute(), dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [x.compute() if isinstance(x, CaptureArray) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
@@ -0,0 +1,104 @@
+import logging
+
+import numpy as np
+from scipy import constants as C
+
+from .fft_backend import fft2, ifft2
+from .rma import center_pad, phase_factor
+
+_logger = logging.getLogger(__name__)
+
+# TI 4-chip cascade EVM (MMWCAS-RF-EVM) 天线位置，单位半波长，(水平, 垂直)
+# rx 按 repack.rx_tabel 的输出顺序（slave3, master, slave2, slave1），正好是水平位置从小到大
+rx_position = np.stack(
+    (
+        np.asarray([0, 1, 2, 3, 11, 12, 13, 14, 46, 47, 48, 49, 50, 51, 52, 53]),
+        np.zeros(16, dtype=int),
+    ),
+    axis=-1,
+)
+# tx 按帧内 chirp 顺序，TI 级联 MIMO 默认从 TX12 发到 TX1；改过 chirp 配置的话要换成对应顺序
+tx_position = np.stack(
+    (
+        np.asarray([0, 4, 8, 12, 16, 20, 24, 28, 32, 9, 10, 11]),
+        np.asarray([0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 4, 6]),
+    ),
+    axis=-1,
+)
+antenna_spacing = 0.5 * C.c / 79e9  # 半波长，按 EVM 的设计中心频率 79GHz
+
+
+def virtual_array(tx_pos: np.ndarray = None, rx_pos: np.ndarray = None, spacing: float = antenna_spacing):
+    """Monostatic equivalent of every tx / rx pair.
+
+    Arguments:
+        tx_pos, rx_pos: (12, 2) / (16, 2) antenna positions in half wavelengths, default the EVM tables,
+            the first coordinate lies along the scan columns (x), the second along the rows (y)
+    Return:
+        virtual: (16 rx, 12 tx, 2) midpoint of every pair in m
+        baseline2: (16 rx, 12 tx) squared tx / rx distance in m^2
+    """
+    tx = (tx_position if tx_pos is None else np.asarray(tx_pos)) * spacing
+    rx = (rx_position if rx_pos is None else np.asarray(rx_pos)) * spacing
+    virtual = (rx[:, None] + tx[None, :]) / 2
+    baseline2 = ((rx[:, None] - tx[None, :]) ** 2).sum(axis=-1)
+    return virtual, baseline2
+
+
+def monostatic_phase(baseline2: np.ndarray, R, k):
+    """Phase correction of every channel from its bistatic path to the monostatic one at its midpoint.
+
+    A target at range R sees the tx / rx pair as the midpoint plus an extra path of about
+    baseline^2 / (4 R), which is removed.
+    """
+    return np.exp(-1j * k * baseline2 / (4 * R))
+
+
+def mimo_image(
+    echo,
+    dx,
+    dy,
+    R,
+    k,
+    nFFTspace=512,
+    batch: int = 2,
+    tx_pos: np.ndarray = None,
+    rx_pos: np.ndarray = None,
+    dtype=np.complex64,
+):
+    """Coherent RMA image of one range bin from all 16 x 12 channels of the virtual array.
+
+    Every channel is corrected to its monostatic equivalent, transformed over the aperture and
+    shifted by its virtual position in the spatial frequency domain. The spectra are summed and
+    focused once, so the whole array costs one fft2 per channel and a single ifft2.
+
+    Arguments:
+        echo: (16 rx, 12 tx, row, col) echoes of one range bin, e.g.
+            frame_file.to_complex().range_fft()[..., bin], calibrate it first when weights are known
+        R, k: focus range in m and wave number, like rma
+        batch: rx read and transformed at a time (batch * 12 channels), bounds the memory
+        tx_pos, rx_pos: antenna tables, see virtual_array
+    Return:
+        (nFFTspace, nFFTspace) image, pixel (i, j) is padded aperture position (i, j) like rma, for
+        the virtual element at the origin of the antenna tables
+    """
+    virtual, baseline2 = virtual_array(tx_pos, rx_pos)
+    n_rx, n_tx = virtual.shape[:2]
+    if tuple(echo.shape[:2]) != (n_rx, n_tx):
+        raise ValueError(f"echo must start with ({n_rx} rx, {n_tx} tx) channels, got {echo.shape[:2]}")
+    correction = monostatic_phase(baseline2, R, k).astype(dtype)
+    kx = 2 * np.pi * np.fft.fftfreq(nFFTspace, dx * 1e-3)
+    ky = 2 * np.pi * np.fft.fftfreq(nFFTspace, dy * 1e-3)
+
+    spectrum = np.zeros((nFFTspace, nFFTspace), dtype=dtype)
+    for r0 in range(0, n_rx, batch):
+        block = np.asarray(echo[r0 : r0 + batch]).astype(dtype, copy=False)
+        block = block * correction[r0 : r0 + batch, :, None, None]
+        block = fft2(center_pad(block, nFFTspace)).reshape(-1, nFFTspace, nFFTspace)
+        # 通道在 v 处测得的场景，平移回阵列原点：乘 exp(-j (kx vx + ky vy))，两个方向可分离
+        v = virtual[r0 : r0 + batch].reshape(-1, 2)
+        shift_x = np.exp(-1j * kx[None, :] * v[:, :1]).astype(dtype)
+        shift_y = np.exp(-1j * ky[None, :] * v[:, 1:]).astype(dtype)
+        spectrum += np.einsum("cyx,cy,cx->yx", block, shift_y, shift_x)
+    _logger.debug(f"summed {n_rx * n_tx} channels")
+    return ifft2(spectrum * phase_factor(dx, dy, R, k, nFFTspace, dtype))
@@ -0,0 +1,166 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from mmwave import schemas
+from .capture_index import load_capture_index
+from .repack import MMWFrame, get_bracket_idx, get_data_files_path, get_range_bins, range_fft
+
+_logger = logging.getLogger(__name__)
+
+
+def read_line_profiles(
+    input_dir: Path, cfg: schemas.MMWConfig, lines: np.ndarray, search_frames: int, device: str = "master", tx: int = 0
+):
+    """Range profile magnitude of a few scan lines, each widened by search_frames on both sides.
+
+    Only one chirp of one tx of one device is read, the 4 rx of the device are summed
+    incoherently, so this is a small fraction of a full repack.
+
+    Return:
+        (lines, col + 2 * search_frames, bins) unit norm, zero mean profiles, nan where no frame was recorded
+    """
+    frame_periodicity = cfg.mimo.frame.framePeriodicity
+    col_num = cfg.bracket.profile.col
+    bracket_idx, _ = get_bracket_idx(input_dir, col_num, frame_periodicity)
+    index = load_capture_index(input_dir)
+    data_idx = index.align(cfg.bracket.profile.offset_time, frame_periodicity, log=False)
+
+    bin_files_path, _ = get_data_files_path(input_dir, device)
+    mmw_frame = MMWFrame(
+        bin_files_path, cfg.mimo.profile.numAdcSamples, cfg.mimo.frame.numLoops, data_idx[device], index.file_frames(device)
+    )
+    positions = bracket_idx[lines, :1] - search_frames + np.arange(col_num + 2 * search_frames)
+    frames = mmw_frame.take(positions.ravel(), 0, tx)  # (pos, 4, samples, 2)
+    profile = np.abs(range_fft(frames, get_range_bins(cfg))).sum(axis=1)
+
+    profile -= profile.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profile /= np.linalg.norm(profile, axis=-1, keepdims=True)  # 没有记录的帧全零，得到 nan
+    return profile.reshape(*positions.shape, -1)
+
+
+def edge_score(profile: np.ndarray, col_num: int):
+    """Score of every shift from the line edges: inside a scan line consecutive frames look alike.
+
+    Return:
+        (2 * search_frames + 1,) mean correlation of consecutive frames inside the shifted windows,
+        index e is the window starting at widened frame e
+    """
+    consecutive = (profile[:, 1:] * profile[:, :-1]).sum(axis=-1)  # (lines, width - 1)
+    windows = sliding_window_view(consecutive, col_num - 1, axis=1)  # (lines, shifts, col - 1)
+    return np.nanmean(windows, axis=(0, 2))
+
+
+def xcorr_score(profile: np.ndarray, col_num: int, pairs: np.ndarray):
+    """Score of every shift from adjacent scan lines scanned in opposite directions.
+
+    An offset error moves a forward line and the following backward line apart by twice the error,
+    they line up again only at the right shift.
+
+    Arguments:
+        pairs: (pair, 2) positions in profile of two adjacent lines, the second one scanned backwards
+    """
+    profile = np.nan_to_num(profile)
+    windows = sliding_window_view(profile, col_num, axis=1)  # (lines, shifts, bins, col)
+    a, b = windows[pairs[:, 0]], windows[pairs[:, 1], ..., ::-1]
+    return np.einsum("psbc,psbc->s", a, b) / (pairs.shape[0] * col_num)
+
+
+def estimate_offset_time(
+    input_dir: Path, cfg: schemas.MMWConfig, search: float = 1.0, max_pairs: int = 8, method: str = "auto"
+):
+    """Find bracket.profile.offset_time from the raw data, searching cfg's offset_time ± search seconds.
+
+    Every candidate offset shifts all scan lines by a whole number of frames. The shifts are scored
+    with xcorr_score for scans with next_line_reverse and with edge_score otherwise (or as method
+    says), and the best one is refined to a fraction of a frame by a parabola through its neighbours.
+
+    Return:
+        dict with offset_time, the shift in frames against cfg's offset_time, the score curve and
+        its contrast (peak above median), offset_time is kept when the curve is flat
+    """
+    input_dir = Path(input_dir)
+    frame_periodicity = cfg.mimo.frame.framePeriodicity
+    row_num, col_num = cfg.bracket.profile.row, cfg.bracket.profile.col
+    if method == "auto":
+        method = "xcorr" if cfg.bracket.profile.next_line_reverse else "edge"
+    if method == "xcorr" and not cfg.bracket.profile.next_line_reverse:
+        raise ValueError("xcorr needs a scan with next_line_reverse, use the edge method")
+    if row_num < 2:
+        raise ValueError("offset estimation needs at least 2 scan lines")
+
+    search_frames = max(1, int(np.ceil(search * 1000 / frame_periodicity)))
+    starts = np.unique(np.linspace(0, row_num - 2, max_pairs).astype(int))
+    starts += starts % 2  # 正向行在前，反向行在后
+    starts = np.unique(starts[starts <= row_num - 2])
+    lines = np.unique(np.concatenate((starts, starts + 1)))
+    profile = read_line_profiles(input_dir, cfg, lines, search_frames)
+
+    if method == "xcorr":
+        pairs = np.searchsorted(lines, np.stack((starts, starts + 1), axis=-1))
+        score = xcorr_score(profile, col_num, pairs)
+    else:
+        score = edge_score(profile, col_num)
+
+    # 窗口从第 e 帧开始时，扫描位置比原来晚 search_frames - e 帧
+    shifts = search_frames - np.arange(score.shape[0])
+    best = int(np.nanargmax(score))
+    shift = float(shifts[best])
+    if 0 < best < score.shape[0] - 1:
+        y0, y1, y2 = score[best - 1 : best + 2]
+        curvature = y0 - 2 * y1 + y2
+        if curvature < 0:
+            shift -= 0.5 * (y0 - y2) / curvature  # shifts 递减，顶点偏移取反
+    contrast = float(score[best] - np.nanmedian(score))
+    if not contrast > 1e-3:  # 场景没有结构时各偏移得分相同
+        _logger.warning(f"score curve is flat (contrast {contrast:.2g}), keep offset_time")
+        shift = 0.0
+    elif best in (0, score.shape[0] - 1):
+        _logger.warning(f"best offset is at the edge of the search range ±{search}s, widen it")
+
+    offset_time = float(cfg.bracket.profile.offset_time + shift * frame_periodicity / 1000)
+    _logger.info(f"offset_time {offset_time:.4f}s ({shift:+.2f} frames), method {method}")
+    return {
+        "offset_time": offset_time,
+        "shift_frames": float(shift),
+        "contrast": contrast,
+        "method": method,
+        "lines": lines.tolist(),
+        "offsets": (cfg.bracket.profile.offset_time + shifts * frame_periodicity / 1000).tolist(),
+        "score": np.nan_to_num(score).tolist(),
+    }
+
+
+def main():
+    import json
+    import argparse
+    from .util import load_config, turn_toml
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Estimate bracket offset_time of a capture from its raw data")
+    parser.add_argument("input_dir", type=Path)
+    parser.add_argument("--search", type=float, default=1.0, help="search offset_time ± this many seconds")
+    parser.add_argument("--pairs", type=int, default=8, help="adjacent line pairs read")
+    parser.add_argument("--method", choices=["auto", "xcorr", "edge"], default="auto")
+    parser.add_argument("--write", action="store_true", help="store the estimate in config.toml")
+    parser.add_argument("--json", type=Path, help="write the estimate and score curve to this file")
+    args = parser.parse_args()
+
+    config_path = args.input_dir / "config.toml"
+    cfg = load_config(config_path)
+    result = estimate_offset_time(args.input_dir, cfg, args.search, args.pairs, args.method)
+    print(f"offset_time = {result['offset_time']:.4f}")
+    if args.json:
+        args.json.write_text(json.dumps(result, indent=2))
+    if args.write:
+        cfg.bracket.profile.offset_time = round(result["offset_time"], 4)
+        turn_toml(config_path, cfg.model_dump(exclude_none=True))
+        _logger.info(f"offset_time written to {config_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from mmwave import schemas
+from .archive import data_file_frames
+from .capture_index import load_capture_index
+from .repack import devices, get_bracket_idx, get_data_files_path, get_valid_mask
+
+_logger = logging.getLogger(__name__)
+
+
+def interval_stats(frame_time: np.ndarray, period_us: float):
+    """Dropped / duplicated frames and jitter of one device from its frame timestamps.
+
+    An interval of n periods holds n - 1 dropped frames, an interval rounding to zero or less is a
+    duplicated (or out of order) frame. The jitter is the distance of every interval from its
+    nearest whole number of periods.
+    """
+    interval = np.diff(frame_time.astype(np.int64)).astype(np.float64)
+    steps = np.rint(interval / period_us).astype(np.int64)
+    gap = steps > 1
+    normal = steps >= 1
+    jitter = interval[normal] - steps[normal] * period_us
+    abs_jitter = np.abs(jitter)
+    return {
+        "dropped": int((steps[gap] - 1).sum()),
+        "gaps": int(gap.sum()),
+        "longest_gap": int(steps[gap].max(initial=1) - 1),
+        "duplicated": int((steps <= 0).sum()),
+        "jitter_us": {
+            "mean": float(jitter.mean()) if jitter.size else 0.0,
+            "std": float(jitter.std()) if jitter.size else 0.0,
+            "p99": float(np.percentile(abs_jitter, 99)) if jitter.size else 0.0,
+            "max": float(abs_jitter.max(initial=0)),
+        },
+    }
+
+
+def quality_report(input_dir: Path, cfg: schemas.MMWConfig):
+    """Quality of a raw capture, from the idx files, the data file sizes and timestamps.txt only.
+
+    No frame data is read, so it takes well under a second on multi-GB captures and can gate a
+    download or a repack.
+
+    Return:
+        JSON-able dict with per device frame statistics, file bounds, the frame count mismatch
+        against master and the coverage of every scan line
+    """
+    input_dir = Path(input_dir)
+    frame_periodicity = cfg.mimo.frame.framePeriodicity
+    period_us = frame_periodicity * 1000
+    index = load_capture_index(input_dir)
+    data_idx = index.align(cfg.bracket.profile.offset_time, frame_periodicity, log=False)
+    frame_size = cfg.mimo.frame.numLoops * 12 * 4 * cfg.mimo.profile.numAdcSamples * 2 * np.dtype(np.int16).itemsize
+
+    report = {"input_dir": str(input_dir), "devices": {}, "missing_devices": [d for d in devices if d not in index.devices]}
+    ref_idx = data_idx["master"] if "master" in data_idx else None
+    for device in index.devices:
+        frame_time = index.timestamps(device)
+        bin_files_path, _ = get_data_files_path(input_dir, device)
+        idx_frames = index.file_frames(device)
+        data_frames = np.asarray([data_file_frames(path, frame_size) for path in bin_files_path], dtype=np.int64)
+        file_end = np.cumsum(idx_frames)
+        file_start = file_end - idx_frames
+        file_bounds = [
+            (frame_time[start] * 1e-6, frame_time[end - 1] * 1e-6) if end > start else (None, None)
+            for start, end in zip(file_start, file_end)
+        ]
+
+        stats = {
+            "frames": int(frame_time.shape[0]),
+            "duration_s": float((frame_time[-1] - frame_time[0]) * 1e-6) if frame_time.shape[0] else 0.0,
+            **interval_stats(frame_time, period_us),
+            "files": [
+                {"name": path.name, "idx_frames": int(n_idx), "data_frames": int(n_data), "start_s": start, "end_s": end}
+                for path, n_idx, n_data, (start, end) in zip(bin_files_path, idx_frames, data_frames, file_bounds)
+            ],
+            "idx_data_mismatch": int(np.abs(idx_frames[: data_frames.shape[0]] - data_frames[: idx_frames.shape[0]]).sum()),
+        }
+        if ref_idx is not None and device != "master":
+            stats["frames_vs_master"] = stats["frames"] - int(ref_idx.shape[0])
+            stats["missing_vs_master"] = int(np.setdiff1d(ref_idx, data_idx[device]).shape[0])
+            stats["extra_vs_master"] = int(np.setdiff1d(data_idx[device], ref_idx).shape[0])
+        report["devices"][device] = stats
+
+    if (input_dir / "timestamps.txt").exists() and not report["missing_devices"]:
+        bracket_idx, _ = get_bracket_idx(input_dir, cfg.bracket.profile.col, frame_periodicity)
+        bracket_idx = bracket_idx[: cfg.bracket.profile.row]
+        # 按 idx 记录算覆盖率，不打开数据文件；数据文件长度不对时上面的 idx_data_mismatch 已经报告
+        profile = cfg.bracket.profile
+        mask = np.stack(
+            [get_valid_mask(data_idx[device], bracket_idx, profile.col, None, profile.next_line_reverse) for device in devices]
+        )
+        line_coverage = mask.mean(axis=-1)  # (device, line)
+        report["lines"] = {
+            "count": int(bracket_idx.shape[0]),
+            "expected": cfg.bracket.profile.row,
+            "coverage": float(mask.mean()),
+            "min_line_coverage": float(line_coverage.min(initial=1)),
+            "incomplete_lines": np.flatnonzero(line_coverage.min(axis=0, initial=1) < 1).tolist(),
+            "device_coverage": {device: float(cov.mean()) for device, cov in zip(devices, line_coverage)},
+        }
+    return report
+
+
+def check_report(report: dict, max_drop_rate: float = None, min_coverage: float = None):
+    """Reasons a capture fails the given thresholds, empty if it passes."""
+    problems = [f"{device} missing" for device in report["missing_devices"]]
+    for device, stats in report["devices"].items():
+        if stats["idx_data_mismatch"]:
+            problems.append(f"{device} idx and data files disagree by {stats['idx_data_mismatch']} frames")
+        expected = stats["frames"] + stats["dropped"]
+        if max_drop_rate is not None and expected and stats["dropped"] / expected > max_drop_rate:
+            problems.append(f"{device} dropped {stats['dropped']} of {expected} frames")
+    lines = report.get("lines")
+    if min_coverage is not None:
+        if lines is None:
+            problems.append("no scan lines to check coverage")
+        elif lines["min_line_coverage"] < min_coverage or lines["count"] < lines["expected"]:
+            problems.append(
+                f"{lines['count']} of {lines['expected']} lines, min line coverage {lines['min_line_coverage'] * 100:.2f}%"
+            )
+    return problems
+
+
+def main():
+    import argparse
+    from .util import load_config
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Check a raw capture for dropped frames, jitter and scan coverage")
+    parser.add_argument("input_dir", type=Path)
+    parser.add_argument("--json", type=Path, help="write the report to this file instead of stdout")
+    parser.add_argument("--max-drop-rate", type=float, help="fail if a device dropped more than this ratio of frames")
+    parser.add_argument("--min-coverage", type=float, help="fail if a scan line has less than this ratio of positions")
+    args = parser.parse_args()
+
+    cfg = load_config(args.input_dir / "config.toml")
+    report = quality_report(args.input_dir, cfg)
+    report["problems"] = check_report(report, args.max_drop_rate, args.min_coverage)
+    report["passed"] = not report["problems"]
+
+    text = json.dumps(report, indent=2)
+    if args.json:
+        args.json.write_text(text)
+    else:
+        print(text)
+    if not report["passed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
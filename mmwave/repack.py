@@ -1,11 +1,20 @@
 from pathlib import Path
+import os
+import json
+import mmap
+import time
+import shutil
 import numpy as np
-import scipy
-import scipy.interpolate
 import logging
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
 
 from mmwave import schemas
+from .archive import ArchiveArray, archive_suffix, data_file_frames
+from .fft_backend import fft
 
 _logger = logging.getLogger(__name__)
 rx_tabel = {  # RX channel order on TI 4-chip cascade EVM
@@ -14,37 +23,52 @@ rx_tabel = {  # RX channel order on TI 4-chip cascade EVM
     "slave2": np.asarray([8, 9, 10, 11]),
     "slave1": np.asarray([12, 13, 14, 15]),
 }  # 这里不知道为什么和手册对不上 手册是 slave2 master slave3 slave1
+devices = ["master", "slave1", "slave2", "slave3"]
+shm_path = Path("/dev/shm")  # process engine 的 SharedMemory 所在的 tmpfs
+# 重组结果的版本，写进 repack_manifest.json 的缓存键，见 cache.cache_key
+# 规则：输出的格式、轴顺序、帧对齐方式或任何会改变已写出数组内容的改动，都要在同一个提交里加一，
+# 否则旧的 all_mmw_array.npy / range_profile.npy 仍被 load_frame、load_range_profile、repack-batch 当作最新复用
+# 1: 初版；2: 每个设备按自己的时间戳对齐到 master（CaptureIndex.align）；
+# 3: next_line_reverse 的回程行沿扫描位置翻转（之前误翻转了 rx），有效掩码同样翻转
+repack_version = 3
+
+
+idx_header_dtype = np.dtype(  # *_idx.bin 文件头
+    [
+        ("tag", np.uint32),
+        ("version", np.uint32),
+        ("flags", np.uint32),
+        ("numIdx", np.uint32),
+        ("size", np.uint64),
+    ]
+)
+idx_record_dtype = np.dtype(  # *_idx.bin 每帧一条记录，timestamp 单位 us
+    [
+        ("tag", np.uint16),
+        ("version", np.uint16),
+        ("flags", np.uint32),
+        ("width", np.uint16),
+        ("height", np.uint16),
+        ("_meta0", np.uint32),
+        ("_meta1", np.uint32),
+        ("_meta2", np.uint32),
+        ("_meta3", np.uint32),
+        ("size", np.uint32),
+        ("timestamp", np.uint64),
+        ("offset", np.uint64),
+    ]
+)
 
 
 def get_idx_info(idx_file: Path):
-    dt = np.dtype(
-        [
-            ("tag", np.uint32),
-            ("version", np.uint32),
-            ("flags", np.uint32),
-            ("numIdx", np.uint32),
-            ("size", np.uint64),
-        ]
-    )
-    header = np.fromfile(idx_file, dtype=dt, count=1)[0]
-
-    dt = np.dtype(
-        [
-            ("tag", np.uint16),
-            ("version", np.uint16),
-            ("flags", np.uint32),
-            ("width", np.uint16),
-            ("height", np.uint16),
-            ("_meta0", np.uint32),
-            ("_meta1", np.uint32),
-            ("_meta2", np.uint32),
-            ("_meta3", np.uint32),
-            ("size", np.uint32),
-            ("timestamp", np.uint64),
-            ("offset", np.uint64),
-        ]
-    )
-    data = np.fromfile(idx_file, dtype=dt, count=-1, offset=24)
+    dt = idx_header_dtype
+    file_size = Path(idx_file).stat().st_size  # 正在写入的文件可能只有半条记录
+    header = np.fromfile(idx_file, dtype=dt, count=1)[0] if file_size >= dt.itemsize else np.zeros(1, dtype=dt)[0]
+    header_size = dt.itemsize
+
+    dt = idx_record_dtype
+    count = max(0, (file_size - header_size) // dt.itemsize)
+    data = np.fromfile(idx_file, dtype=dt, count=count, offset=header_size) if count else np.zeros(0, dtype=dt)
     return header, data
 
 
@@ -60,6 +84,8 @@ def get_data_files_path(inputdir: Path, device: str):
     """
     inputdir = Path(inputdir)
     data = sorted(inputdir.glob(f"{device}*_data.bin"))
+    if not data:  # 原始文件已压缩归档，见 archive.py
+        data = sorted(inputdir.glob(f"{device}*_data{archive_suffix}"))
     idx = sorted(inputdir.glob(f"{device}*_idx.bin"))
     if len(data) == 0 or len(idx) == 0:
         raise FileNotFoundError(f"No data or index files found for {device} in the input directory")
@@ -74,7 +100,7 @@ def get_data_files_path(inputdir: Path, device: str):
     return data, idx
 
 
-def load_bin_file(bin_file: Path, samples_num: int, chrips_num: int, chrip_idx: int = 1):
+def load_bin_file(bin_file: Path, samples_num: int, chrips_num: int, chrip_idx: int = 1, frames_num: int = None):
     """Re-Format the raw radar ADC recording.
     The raw recording from each device is merge together to create
     separate recording frames corresponding to the MIMO configuration.
@@ -82,6 +108,7 @@ def load_bin_file(bin_file: Path, samples_num: int, chrips_num: int, chrip_idx:
         bin_file: Path to the recording file of the device
         samples_num: Number of ADC samples per chirp
         chrips_num: Number of chrips per frame
+        frames_num: Only map this many frames, for files that are still being written
     Return:
         The index number of the last frame generated
     Note:
@@ -100,9 +127,14 @@ def load_bin_file(bin_file: Path, samples_num: int, chrips_num: int, chrip_idx:
     nrx = 4  # 接收天线数目
     nitems = chrips_num * ntx * devices_num * samples_num * nrx * nwave
 
-    bin_file_array = np.memmap(bin_file, dtype=np.int16, mode="r")
-    # bin_file_array = np.fromfile(bin_file, dtype=np.int16)
-    assert bin_file_array.shape[0] % nitems == 0
+    if Path(bin_file).suffix == archive_suffix:
+        return ArchiveArray(bin_file, samples_num, chrips_num, frames_num)
+    if frames_num is None:
+        bin_file_array = np.memmap(bin_file, dtype=np.int16, mode="r")
+        # bin_file_array = np.fromfile(bin_file, dtype=np.int16)
+        assert bin_file_array.shape[0] % nitems == 0
+    else:
+        bin_file_array = np.memmap(bin_file, dtype=np.int16, mode="r", shape=(frames_num * nitems,))
 
     res = bin_file_array.reshape(-1, nitems)
     res = bin_file_array.reshape(-1, chrips_num, ntx * devices_num, samples_num, nrx, nwave)
@@ -112,35 +144,85 @@ def load_bin_file(bin_file: Path, samples_num: int, chrips_num: int, chrip_idx:
     return res
 
 
+def frame_time_to_idx(frame_time: np.ndarray, offset_time: float, frame_periodicity: float, t0: float = None):
+    """Turn frame timestamps (us) into scan frame numbers.
+
+    t0: timestamp of scan frame offset_time, default the first frame
+    """
+    t0 = frame_time[0] if t0 is None else t0
+    data_idx = (np.asarray(frame_time, dtype=np.float64) - float(t0) + offset_time * 1e6) / 1000 / frame_periodicity
+    # data_idx = (data_idx + offset_time * 1e6) / 1000 / frame_periodicity
+
+    data_idx = np.rint(data_idx).astype(int)
+    return data_idx
+
+
 def get_data_idx(idxs_path: list, offset_time: float, frame_periodicity: float):
     all_frame_time = []
     for idx_path in idxs_path:
         header_info, frame_info = get_idx_info(idx_path)
         # _logger.info(f"header_info: {header_info}")
-        frame_time = np.array([i[-2] for i in frame_info])
-        all_frame_time.append(frame_time)
+        all_frame_time.append(frame_info["timestamp"])
 
-    data_idx = np.concatenate(all_frame_time)
-
-    data_idx = (data_idx - data_idx[0] + offset_time * 1e6) / 1000 / frame_periodicity
-    # data_idx = (data_idx + offset_time * 1e6) / 1000 / frame_periodicity
-
-    data_idx = np.rint(data_idx).astype(int)
-    return data_idx
+    return frame_time_to_idx(np.concatenate(all_frame_time), offset_time, frame_periodicity)
 
 
 def get_bracket_idx(input_dir: Path, x_sample_num: int, frame_periodicity: float):
     time_info = np.loadtxt(input_dir / "timestamps.txt")
     offset_time = time_info[-1][0]
     time_info = time_info[0:-1]
-    bracket_idx = []
-    for t0, t1 in time_info:
-        start = t0 * 1000 / frame_periodicity
-        end = start + x_sample_num
-        bracket_idx.append((start, end))
-    bracket_idx = np.asarray(bracket_idx)
+    return line_time_to_idx(time_info, x_sample_num, frame_periodicity), offset_time
+
+
+def line_time_to_idx(time_info: np.ndarray, x_sample_num: int, frame_periodicity: float):
+    """Turn the (start, end) time in s of each scan line into its [start, end) scan frame numbers."""
+    start = np.asarray(time_info, dtype=float).reshape(-1, 2)[:, 0] * 1000 / frame_periodicity
+    bracket_idx = np.stack((start, start + x_sample_num), axis=-1)
     bracket_idx = np.rint(bracket_idx).astype(int)
-    return bracket_idx, offset_time
+    return bracket_idx
+
+
+def get_valid_mask(
+    data_idx: np.ndarray, bracket_idx: np.ndarray, x_sample_num: int, frames_num: int = None, next_line_reverse=False
+):
+    """(row, col) bool mask of the scan positions that hold a recorded frame of one device.
+
+    Built from the frame numbers alone, it matches the positions MMWFrame does not zero fill.
+    With next_line_reverse the odd lines are flipped like turn_device_frame flips them.
+    """
+    data_idx = data_idx[:frames_num]
+    pos = bracket_idx[:, :1] + np.arange(x_sample_num)
+    if next_line_reverse:
+        pos[1::2] = pos[1::2, ::-1]
+    valid = np.zeros(max(pos.max(), data_idx.max(initial=0)) + 1, dtype=bool)
+    valid[data_idx[data_idx >= 0]] = True
+    return valid[np.clip(pos, 0, None)] & (pos >= 0)
+
+
+def save_valid_mask(mask_file_path: Path, mask: np.ndarray):
+    """Save a (device, row, col) validity mask as a packed bitmap."""
+    np.savez(mask_file_path, packed=np.packbits(mask, axis=-1), shape=np.asarray(mask.shape), devices=np.asarray(devices))
+
+
+def load_valid_mask(mask_file_path: Path, rx=False):
+    """Load the validity mask written by turn_frame.
+
+    Return:
+        (device, row, col) bool mask in the order of devices, or (16, row, col) indexed by rx channel if rx
+    """
+    with np.load(mask_file_path) as npz:
+        shape = tuple(npz["shape"])
+        mask = np.unpackbits(npz["packed"], axis=-1, count=shape[-1]).astype(bool)
+        mask_devices = list(npz["devices"])
+    return rx_valid_mask(mask, mask_devices) if rx else mask
+
+
+def rx_valid_mask(mask: np.ndarray, mask_devices: list = devices):
+    """Expand a (device, row, col) validity mask to (16, row, col) indexed by rx channel."""
+    rx_mask = np.zeros((16, *mask.shape[1:]), dtype=bool)
+    for device_mask, device_name in zip(mask, mask_devices):
+        rx_mask[rx_tabel[device_name]] = device_mask
+    return rx_mask
 
 
 def iter_all_frame(bin_files_path: list[Path], samples_num: int, chrips_num: int):
@@ -149,46 +231,196 @@ def iter_all_frame(bin_files_path: list[Path], samples_num: int, chrips_num: int
         yield bin_array
 
 
-def interpolate_zero(data: np.ndarray):
-    grids = [np.arange(dim) for dim in data.shape]
+def open_frame_array(frame_file_path: Path, shape: tuple, dtype=np.int16) -> np.memmap:
+    """Create a zero filled .npy file on disk and map it for writing."""
+    return np.lib.format.open_memmap(frame_file_path, mode="w+", dtype=dtype, shape=shape)
+
+
+def release_pages(array: np.ndarray):
+    """Flush a memmap (or a view of one) and drop its pages from the process resident set.
+
+    The data stays in the page cache / on disk, so later reads simply fault it back in.
+    Arrays that are not backed by a memmap are ignored.
+    """
+    mm = getattr(array, "_mmap", None)
+    if mm is None:
+        return
+    mm.flush()
+    if hasattr(mmap, "MADV_DONTNEED"):  # windows 没有 madvise
+        mm.madvise(mmap.MADV_DONTNEED)
+
+
+def advise_pages(array: np.ndarray, advice: str, start: int = 0, length: int = None):
+    """madvise a byte range of the file behind a memmap (or a view of one).
 
-    interpolator = scipy.interpolate.RegularGridInterpolator(grids, data, method="linear", bounds_error=False, fill_value=0)
+    advice is the name of the mmap constant, e.g. "MADV_WILLNEED" to start reading the range in the
+    background. Arrays that are not memmaps and platforms without the advice are ignored.
+    """
+    mm = getattr(array, "_mmap", None)
+    option = getattr(mmap, advice, None)
+    if mm is None or option is None or len(mm) == 0:
+        return
+    aligned = start - start % mmap.PAGESIZE  # madvise 要求起点按页对齐
+    end = len(mm) if length is None else min(len(mm), start + length)
+    if end > aligned:
+        mm.madvise(option, aligned, end - aligned)
 
-    indices = np.array(np.indices(data.shape)).reshape(len(data.shape), -1).T
-    zero_points = indices[np.ravel(data) == 0]
 
-    interpolator_values = interpolator(zero_points)
-    for idx, value in zip(zero_points, interpolator_values):
-        data[tuple(idx)] = value
-    return data
+class FrameArray:
+    """Random access view over the frames of all *_data.bin (or archived *_data.mwz) files of one device.
+
+    Global frame numbers are mapped to (file, local frame) with per-frame lookup tables built from
+    the frame counts of the idx files, the same records the timestamps (and so data_idx) come from.
+    The files are opened lazily through a small LRU of memmaps, so int, slice and fancy indexes
+    may cross any number of files in any order.
+
+    Arguments:
+        file_frames: frames of every data file listed by its idx file, see CaptureIndex.file_frames
+        partial: the capture is still being written, the last file may hold fewer or more frames than
+            its idx file lists and only the frames in both are mapped, otherwise a data file of the
+            wrong size raises ValueError
+    """
+
+    def __init__(
+        self,
+        bin_files_path: list[Path],
+        samples_num: int,
+        chrips_num: int,
+        file_frames: np.ndarray,
+        cache_size: int = 4,
+        partial=False,
+        advice: str = None,
+    ):
+        self.bin_files_path = list(bin_files_path)
+        self.samples_num = samples_num
+        self.chrips_num = chrips_num
+        self.cache_size = cache_size
+        self.partial = partial  # 文件还在写入，只映射已经写完的整帧
+        self.advice = advice  # 打开文件时的访问方式提示，如 "MADV_SEQUENTIAL"
+
+        frame_size = chrips_num * 3 * 4 * samples_num * 4 * 2 * np.dtype(np.int16).itemsize
+        self.frame_size = frame_size
+        data_frames = np.asarray([data_file_frames(i, frame_size) for i in self.bin_files_path], dtype=np.int64)
+        file_frames = np.asarray(file_frames, dtype=np.int64)
+        if partial:  # 边采集边重组时新文件的索引可能还没写，按数据文件个数补零
+            file_frames = np.pad(file_frames, (0, max(0, data_frames.shape[0] - file_frames.shape[0])))
+            file_frames = file_frames[: data_frames.shape[0]]
+        elif file_frames.shape[0] != data_frames.shape[0]:
+            raise ValueError(f"{data_frames.shape[0]} data files but {file_frames.shape[0]} idx files")
+        for file_i, (path, n_data, n_idx) in enumerate(zip(self.bin_files_path, data_frames, file_frames)):
+            if n_data != n_idx and not (partial and file_i == data_frames.shape[0] - 1):
+                raise ValueError(f"{path.name} holds {n_data} frames but its idx file lists {n_idx}")
+        file_frames = np.minimum(file_frames, data_frames)
+        self.file_frames = file_frames
+        self.file_start = np.concatenate(([0], np.cumsum(file_frames)))
+        self.frame_file = np.repeat(np.arange(len(file_frames), dtype=np.int32), file_frames)
+        self.frame_local = np.arange(self.file_start[-1]) - self.file_start[self.frame_file]
+
+        self.shape = (int(self.file_start[-1]), chrips_num, 12, 4, samples_num, 2)
+        self.dtype = np.dtype(np.int16)
+
+        self._cache: OrderedDict[int, np.ndarray] = OrderedDict()
+        self._cache_lock = Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def file_array(self, file_i: int) -> np.ndarray:
+        with self._cache_lock:
+            if file_i in self._cache:
+                self._cache.move_to_end(file_i)
+                return self._cache[file_i]
+            frames_num = int(self.file_frames[file_i]) if self.partial else None
+            bin_array = load_bin_file(self.bin_files_path[file_i], self.samples_num, self.chrips_num, frames_num=frames_num)
+            if self.advice:
+                advise_pages(bin_array, self.advice)
+            self._cache[file_i] = bin_array
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return bin_array
+
+    def prefetch(self, start: int, stop: int):
+        """Ask the kernel to read frames [start, stop) ahead in the background."""
+        start, stop = max(start, 0), min(stop, len(self))
+        if start >= stop:
+            return
+        for file_i in range(self.frame_file[start], self.frame_file[stop - 1] + 1):
+            local_start = max(start, self.file_start[file_i]) - self.file_start[file_i]
+            local_stop = min(stop, self.file_start[file_i + 1]) - self.file_start[file_i]
+            length = (local_stop - local_start) * self.frame_size
+            advise_pages(self.file_array(file_i), "MADV_WILLNEED", int(local_start * self.frame_size), int(length))
+
+    def release_pages(self):
+        with self._cache_lock:
+            bin_arrays = list(self._cache.values())
+        for bin_array in bin_arrays:
+            release_pages(bin_array)
+
+    def __getitem__(self, i) -> np.ndarray:
+        if isinstance(i, tuple):
+            i, args = i[0], i[1:]
+        else:
+            args = ()
+
+        if isinstance(i, (int, np.integer)):
+            i = int(i) + len(self) if i < 0 else int(i)
+            return self.file_array(self.frame_file[i])[self.frame_local[i], *args]
+
+        frames = np.arange(len(self))[i]
+        out = np.empty((0, *self.shape[1:]), dtype=self.dtype)[:, *args]
+        out = np.empty((frames.shape[0], *out.shape[1:]), dtype=self.dtype)
+
+        frame_file = self.frame_file[frames]
+        for file_i in np.unique(frame_file):
+            sel = np.flatnonzero(frame_file == file_i)
+            local = self.frame_local[frames[sel]]
+            bin_array = self.file_array(file_i)
+            if local[-1] - local[0] == local.shape[0] - 1 and np.all(np.diff(local) == 1):
+                part = bin_array[local[0] : local[-1] + 1]
+            else:
+                part = bin_array[local]
+            if sel[-1] - sel[0] == sel.shape[0] - 1:
+                out[sel[0] : sel[-1] + 1] = part[:, *args]
+            else:
+                out[sel] = part[:, *args]
+        return out
 
 
 class MMWFrame:
-    def __init__(self, bin_files_path: Path, samples_num: int, chrips_num: int, data_idx: np.ndarray):
+    """Scan position view of one device, the j-th recorded frame belongs to scan position data_idx[j].
+
+    Slicing with [b_start:b_end] returns the frames of scan positions b_start..b_end-1, positions
+    without a recorded frame are zero filled. An int index returns the raw recorded frame.
+    file_frames and partial are passed to FrameArray.
+    """
+
+    def __init__(
+        self,
+        bin_files_path: list[Path],
+        samples_num: int,
+        chrips_num: int,
+        data_idx: np.ndarray,
+        file_frames: np.ndarray,
+        partial=False,
+        advice: str = None,
+    ):
         self.bin_files_path = bin_files_path
         self.samples_num = samples_num
         self.chrips_num = chrips_num
-        self.data_idx = data_idx
-
-        self.all_frames_iter = iter_all_frame(bin_files_path, samples_num, chrips_num)
-        self.bin_array: np.ndarray = next(self.all_frames_iter)
-        self.shape = self.bin_array.shape[1:]
-        self.dtype = self.bin_array.dtype
+        self.frames = FrameArray(bin_files_path, samples_num, chrips_num, file_frames, partial=partial, advice=advice)
+        self.data_idx = data_idx[: len(self.frames)]
+        self.shape = self.frames.shape[1:]
+        self.dtype = self.frames.dtype
 
-        self.frame_offset = 0
-        self.stop_iteration_flag = False
+    def release_pages(self):
+        self.frames.release_pages()
 
-    def _get_next_bin_array(self):
-        try:
-            self.bin_array = next(self.all_frames_iter)
-            return self.bin_array
-        except StopIteration:
-            self.stop_iteration_flag = True
+    def prefetch(self, b_start: int, b_end: int):
+        """Start reading the frames of scan positions b_start..b_end-1 in the background."""
+        start, end = np.searchsorted(self.data_idx, [b_start, b_end])
+        self.frames.prefetch(int(start), int(end))
 
     def __getitem__(self, i) -> np.ndarray:
-        bin_array = self.bin_array
-        bin_len = bin_array.shape[0]
-        frame_offset = self.frame_offset
         data_idx = self.data_idx
 
         if isinstance(i, tuple):
@@ -198,97 +430,409 @@ class MMWFrame:
 
         if isinstance(i, slice):
             b_start, b_end, step = i.start, i.stop, i.step
-        elif isinstance(i, int):
-            return bin_array[i - self.frame_offset, *args]
+        elif isinstance(i, (int, np.integer)):
+            return self.frames[i, *args]
         else:
             raise ValueError("Index must be int or slice")
 
         start, end = np.searchsorted(data_idx, [b_start, b_end])
-
         mmw_idx = data_idx[start:end] - b_start
 
-        start, end = start - frame_offset, end - frame_offset
-
-        line_frames = bin_array[start:end]
-
-        if end >= bin_len:
-            bin_array = self._get_next_bin_array()
-            if bin_array is not None:
-                start, end = max(0, start - bin_len), end - bin_len
-                line_frames = np.concatenate((line_frames, bin_array[start:end]))
-                self.frame_offset += bin_len
-
-        line_frames = line_frames[:, *args]
+        line_frames = self.frames[start:end, *args]
         new_line_frames = np.zeros((b_end - b_start, *line_frames.shape[1:]), dtype=line_frames.dtype)
         new_line_frames[mmw_idx] = line_frames[:]
         return new_line_frames
 
+    def take(self, positions: np.ndarray, *args) -> np.ndarray:
+        """Frames of arbitrary scan positions, zero filled where nothing was recorded, only those frames are read."""
+        positions = np.asarray(positions)
+        j = np.searchsorted(self.data_idx, positions)
+        found = j < self.data_idx.shape[0]
+        found[found] = self.data_idx[j[found]] == positions[found]
+        frames = self.frames[j[found], *args]
+        out = np.zeros((positions.shape[0], *frames.shape[1:]), dtype=frames.dtype)
+        out[found] = frames
+        return out
+
+
+class RepackROI:
+    """Part of the cube a repack writes: rx devices, tx channels, scan lines and scan positions.
+
+    Output row k holds scan line rows[k] and output col j holds position cols[j] of that line.
+    The rx axis keeps the channels of the selected devices in rx_tabel order.
+    """
+
+    def __init__(self, cfg: schemas.MMWConfig):
+        profile = cfg.repack.profile
+        row_num, col_num = cfg.bracket.profile.row, cfg.bracket.profile.col
+        row_step, col_step = profile.stride
+
+        unknown = set(profile.rx_devices or []) - set(devices)
+        if unknown:
+            raise ValueError(f"unknown rx devices {sorted(unknown)}, choose from {devices}")
+        self.devices = [device for device in devices if profile.rx_devices is None or device in profile.rx_devices]
+        self.rx = np.sort(np.concatenate([rx_tabel[device] for device in self.devices]))
+        self.tx = np.arange(12) if profile.tx is None else np.asarray(profile.tx, dtype=int)
+        self.rows = np.arange(*(profile.rows or (0, row_num)), row_step)
+        self.cols = np.arange(*(profile.cols or (0, col_num)), col_step)
+
+        if not self.devices or self.tx.size == 0 or self.rows.size == 0 or self.cols.size == 0:
+            raise ValueError("repack roi selects nothing")
+        if self.tx.min() < 0 or self.tx.max() >= 12:
+            raise ValueError(f"tx {profile.tx} out of range 0~11")
+        if self.rows.min() < 0 or self.rows.max() >= row_num or self.cols.min() < 0 or self.cols.max() >= col_num:
+            raise ValueError(f"roi rows {profile.rows} cols {profile.cols} out of the {row_num}x{col_num} scan")
+
+        self.full = (
+            len(self.devices) == len(devices)
+            and np.array_equal(self.tx, np.arange(12))
+            and np.array_equal(self.rows, np.arange(row_num))
+            and np.array_equal(self.cols, np.arange(col_num))
+        )
+        self.prefix = "" if self.full else "roi_"  # 局部重组写到 roi_*.npy，不覆盖完整数组
+        self.shape = (self.rx.shape[0], self.tx.shape[0], self.rows.shape[0], self.cols.shape[0])
+
+    def rx_idx(self, device_name: str):
+        """Positions of the rx channels of a device along the output rx axis."""
+        return np.searchsorted(self.rx, rx_tabel[device_name])
+
+    def take_mask(self, rx_mask: np.ndarray):
+        """Cut a (16, row, col) validity mask down to the roi."""
+        return rx_mask[np.ix_(self.rx, self.rows, self.cols)]
+
+    def save(self, roi_file_path: Path):
+        info = {"rx": self.rx, "tx": self.tx, "rows": self.rows, "cols": self.cols}
+        roi_file_path.write_text(json.dumps({name: value.tolist() for name, value in info.items()}, indent=2))
+
+
+def load_roi(input_dir: Path):
+    """rx, tx, rows and cols index arrays of the cube in roi_all_mmw_array.npy / roi_range_profile.npy."""
+    info = json.loads((Path(input_dir) / "roi.json").read_text())
+    return {name: np.asarray(value) for name, value in info.items()}
+
+
+def get_chirp_select(cfg: schemas.MMWConfig):
+    """Chirp loops read for every frame and how they are reduced.
+
+    Return:
+        chirps: int index of the loop for select, slice of the loops for mean / all
+        mean: average the loops coherently into one
+    """
+    profile = cfg.repack.profile
+    chrips_num = cfg.mimo.frame.numLoops
+    if profile.chirp_mode == "select":
+        chirp_idx = min(1, chrips_num - 1) if profile.chirp_idx is None else profile.chirp_idx  # 默认取第 2 个 loop
+        if not 0 <= chirp_idx < chrips_num:
+            raise ValueError(f"chirp_idx {chirp_idx} out of range 0~{chrips_num - 1}")
+        return chirp_idx, False
+    start, stop = profile.chirp_window or (0, chrips_num)
+    if not 0 <= start < stop <= chrips_num:
+        raise ValueError(f"chirp_window {profile.chirp_window} out of range 0~{chrips_num}")
+    return slice(start, stop), profile.chirp_mode == "mean"
+
+
+def get_chirp_shape(cfg: schemas.MMWConfig):
+    """Extra output axis holding the chirp loops, () unless chirp_mode is all."""
+    chirps, mean = get_chirp_select(cfg)
+    if isinstance(chirps, slice) and not mean:
+        return (chirps.stop - chirps.start,)
+    return ()
+
+
+def reduce_chirps(line_frames: np.ndarray, mean=False):
+    """(pos, [chirp], 12, 4, samples, 2) frames of a line to (4, 12, pos, [chirp], samples, 2).
+
+    With mean the chirp axis is averaged in float32, vectorized over the whole line.
+    """
+    if line_frames.ndim == 6:
+        if mean:
+            line_frames = line_frames.mean(axis=1, dtype=np.float32)
+        else:
+            return line_frames.transpose(3, 2, 0, 1, 4, 5)
+    return line_frames.transpose(2, 1, 0, 3, 4)
+
+
+def get_range_bins(cfg: schemas.MMWConfig):
+    """Range bins kept by the range FFT stage, all bins by default."""
+    profile = cfg.repack.profile
+    samples_num = cfg.mimo.profile.numAdcSamples
+    if profile.range_bins:
+        range_bins = np.asarray(profile.range_bins, dtype=int)
+        outside = range_bins[(range_bins < 0) | (range_bins >= samples_num)]
+        if outside.shape[0]:
+            raise ValueError(f"range_bins {outside.tolist()} out of range 0~{samples_num - 1}")
+        return range_bins
+    if profile.range_window:
+        start, stop = profile.range_window
+        if not 0 <= start < stop <= samples_num:
+            raise ValueError(f"range_window {profile.range_window} out of range 0~{samples_num}")
+        return np.arange(start, stop)
+    return np.arange(samples_num)
+
+
+def range_fft(frames: np.ndarray, range_bins: np.ndarray = None):
+    """Range FFT over the ADC samples of (..., samples_num, 2) int16 IQ frames.
+
+    Return:
+        complex64 range profiles (..., len(range_bins))
+    """
+    echo = np.empty(frames.shape[:-1], dtype=np.complex64)
+    echo.real = frames[..., 0]
+    echo.imag = frames[..., 1]
+    profile = fft(echo, workers=1)  # 重组已经按行块并行
+    if range_bins is not None:
+        profile = profile[..., range_bins]
+    return profile.astype(np.complex64, copy=False)
+
 
 def turn_device_frame(
     all_frames: np.ndarray,
     mmw_frames: MMWFrame,
     rx_idx: np.ndarray,
-    chirp_idx: int,
+    chirp_idx: int | slice,
     bracket_idx: np.ndarray,
     next_line_reverse=False,
+    line_buffer: int = 0,
+    lines: range = None,
+    range_profile: np.ndarray = None,
+    range_bins: np.ndarray = None,
+    roi: RepackROI = None,
+    chirp_mean=False,
+    readahead: int = 0,
+    prefetch=False,
 ):
-    from tqdm.auto import trange
+    """Write the scan lines of one device into all_frames.
+
+    With line_buffer > 0 the resident pages of all_frames and of the input memmap are released
+    every line_buffer lines, so a memmapped output never holds more than that many lines in RAM.
+    lines restricts the work to a block of scan lines, by default all of them with a progress bar.
+    Lines are independent, so blocks may be repacked in any order.
+    If range_profile is given the range FFT of each line is written into it while the line is
+    still in cache, all_frames may then be None to skip the int16 cube.
+    With roi, lines are output rows: row k reads only the tx and positions of scan line roi.rows[k].
+    chirp_idx picks one chirp loop, or a slice of loops that are kept as an extra axis after col,
+    or averaged coherently when chirp_mean is set, see reduce_chirps.
+    readahead hints the kernel to read the frames of that many following lines in the background,
+    with prefetch a reader thread also copies them ahead into a buffer of readahead + 1 lines.
+    """
+    from tqdm.auto import tqdm
 
-    for i in trange(bracket_idx.shape[0]):
+    progress = lines is None
+    if lines is None:
+        lines = range(bracket_idx.shape[0] if roi is None else roi.rows.shape[0])
+
+    def line_cols(i):
+        """Frames of the roi columns counted from the line start, a reversed line runs from the last column."""
+        start, end = bracket_idx[i]
+        if next_line_reverse and i % 2 == 1:
+            return end - start - 1 - roi.cols[::-1]
+        return roi.cols
+
+    def line_range(k):
+        i = k if roi is None else roi.rows[k]
         start, end = bracket_idx[i]
-        line_frames = mmw_frames[start:end, chirp_idx].transpose(2, 1, 0, 3, 4)
-        if next_line_reverse and (i % 2 == 1):
-            all_frames[rx_idx, :, i] = line_frames[::-1]
+        if roi is not None:
+            cols = line_cols(i)
+            start, end = start + cols[0], start + cols[-1] + 1
+        return i, start, end
+
+    def read_line(k):
+        i, start, end = line_range(k)
+        if roi is None or (np.array_equal(roi.tx, np.arange(12)) and np.all(np.diff(roi.cols) == 1)):
+            return mmw_frames[start:end, chirp_idx]
+        return mmw_frames.take(bracket_idx[i][0] + line_cols(i), chirp_idx, roi.tx)
+
+    def hint_line(n):
+        if readahead and n < len(lines):
+            mmw_frames.prefetch(*line_range(lines[n])[1:])
+
+    for n in range(readahead):
+        hint_line(n)
+    reader = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    buffer = deque(reader.submit(read_line, lines[n]) for n in range(min(readahead + 1, len(lines)))) if reader else None
+    try:
+        for n, k in enumerate(tqdm(lines) if progress else lines):
+            hint_line(n + readahead)
+            if reader:
+                line_frames = buffer.popleft().result()
+                if n + readahead + 1 < len(lines):  # 缓冲区最多 readahead + 1 行
+                    buffer.append(reader.submit(read_line, lines[n + readahead + 1]))
+            else:
+                line_frames = read_line(k)
+
+            i = line_range(k)[0]
+            line_frames = reduce_chirps(line_frames, chirp_mean)
+            if next_line_reverse and (i % 2 == 1):
+                line_frames = line_frames[:, :, ::-1]  # (4, 12, pos, ...) 沿扫描位置翻转
+
+            if all_frames is not None:
+                all_frames[rx_idx, :, k] = np.rint(line_frames) if chirp_mean else line_frames
+            if range_profile is not None:
+                range_profile[rx_idx, :, k] = range_fft(line_frames, range_bins)
+
+            if line_buffer and (k + 1) % line_buffer == 0:
+                release_pages(all_frames)
+                release_pages(range_profile)
+                mmw_frames.release_pages()
+    finally:
+        if reader:
+            reader.shutdown(wait=True, cancel_futures=True)
+
+    if line_buffer:
+        release_pages(all_frames)
+        release_pages(range_profile)
+
+
+class RepackOutput:
+    """One output array of the repack, kept in RAM, in shared memory or memmapped on disk.
+
+    spec is the picklable handle passed to the workers, see attach.
+    """
+
+    def __init__(self, file_path: Path, shape: tuple, dtype, stream=False, engine="process"):
+        self.file_path = Path(file_path)
+        self.stream = stream
+        self.shm = None
+        if stream:
+            # 先写到临时文件，完成后再改名，避免中断后留下半成品被 load_frame 复用
+            self.part_file_path = self.file_path.with_name(self.file_path.stem + ".part.npy")
+            self.array = open_frame_array(self.part_file_path, shape, dtype)
+            self.spec = ("memmap", self.part_file_path, shape, dtype)
+        elif engine == "process":
+            size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+            self.spec = ("shm", self.shm.name, shape, dtype)
+        else:
+            self.array = np.zeros(shape, dtype=dtype)
+        if engine == "thread":  # thread engine 直接共享数组
+            self.spec = self.array
+
+    @staticmethod
+    def attach(spec):
+        """Open an output inside a worker, return the array and the shared memory to close."""
+        if spec is None or isinstance(spec, np.ndarray):
+            return spec, None
+        kind, target, shape, dtype = spec
+        if kind == "memmap":
+            return np.load(target, mmap_mode="r+"), None
+        shm = shared_memory.SharedMemory(name=target, track=False)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+    def save(self):
+        if self.stream:
+            release_pages(self.array)
+            self.array = None  # windows 下文件改名前要先释放映射
+            self.part_file_path.replace(self.file_path)
         else:
-            all_frames[rx_idx, :, i] = line_frames
-
-        if mmw_frames.stop_iteration_flag:
-            break
-
-
-def check_data_idx(input_dir: Path):
-    import matplotlib.pyplot as plt
-
-    for idx_num in ["master", "slave1", "slave2", "slave3"]:
-        idxs_path = sorted(input_dir.glob(f"{idx_num}*_idx.bin"))
-        all_frame_time = []
-        for idx_path in idxs_path:
-            header_info, frame_info = get_idx_info(idx_path)
-            frame_time0 = frame_info[0][-2] * 1e-6
-            frame_time1 = frame_info[-1][-2] * 1e-6
-            print(frame_time0, frame_time1)
-            frame_time = np.array([i[-2] for i in frame_info]) * 1e-6
-            all_frame_time.append(frame_time)
-        frame_time = np.concatenate(all_frame_time)
-        dframe_time = frame_time[1:] - frame_time[:-1]
-        plt.plot(dframe_time)
-    plt.grid()
-    plt.show()
-
-
-def turn_frame(input_dir: Path, cfg: schemas.MMWConfig):
-    adc_samples_num = cfg.mimo.profile.numAdcSamples  # number of ADC samples per chirp
+            np.save(self.file_path, self.array)
+
+    def close(self):
+        self.array = None  # shm.close 要求先释放数组对共享内存的引用
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def turn_block_frame(
+    outputs: dict,
+    input_dir: Path,
+    cfg: schemas.MMWConfig,
+    device_name: str,
+    data_idx: np.ndarray,
+    file_frames: np.ndarray,
+    bracket_idx: np.ndarray,
+    lines: range,
+):
+    """Repack one block of output rows of one device, the unit of work of the repack scheduler."""
+    chrips_num = cfg.mimo.frame.numLoops
+    chirp_idx, chirp_mean = get_chirp_select(cfg)
+    line_buffer = cfg.repack.profile.line_buffer if cfg.repack.profile.stream else 0
+
+    roi = RepackROI(cfg)
+
+    all_frames, frame_shm = RepackOutput.attach(outputs.get("frame"))
+    range_profile, range_shm = RepackOutput.attach(outputs.get("range_profile"))
+    try:
+        bin_files_path, _ = get_data_files_path(input_dir, device_name)
+        readahead = cfg.repack.profile.readahead
+        advice = "MADV_SEQUENTIAL" if readahead else None  # 行内按顺序读，让内核加大预读
+        mmw_frame = MMWFrame(bin_files_path, cfg.mimo.profile.numAdcSamples, chrips_num, data_idx, file_frames, advice=advice)
+        turn_device_frame(
+            all_frames,
+            mmw_frame,
+            roi.rx_idx(device_name),
+            chirp_idx,
+            bracket_idx,
+            cfg.bracket.profile.next_line_reverse,
+            line_buffer,
+            lines,
+            range_profile,
+            get_range_bins(cfg) if range_profile is not None else None,
+            None if roi.full else roi,
+            chirp_mean,
+            readahead,
+            cfg.repack.profile.prefetch,
+        )
+        release_pages(all_frames)
+        release_pages(range_profile)
+    finally:
+        del all_frames, range_profile
+        for shm in (frame_shm, range_shm):
+            if shm is not None:
+                shm.close()
+    return device_name, lines
+
+
+@contextmanager
+def stage_timer(timings: dict, name: str):
+    """Add the wall time spent in the block to timings[name], a no-op when timings is None."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def turn_frame(input_dir: Path, cfg: schemas.MMWConfig, timings: dict = None):
+    """Repack a capture into all_mmw_array.npy and / or range_profile.npy.
+
+    timings: if given, the wall time of each stage (index, mask, repack, finish) is added to it
+    """
     chrips_num = cfg.mimo.frame.numLoops  # number of chrips per frame
-    chrip_idx = min(1, chrips_num - 1)  # use chirp 1 if chirp num big than 1
     _logger.info(f"chrips_num: {chrips_num}")
     frame_periodicity = cfg.mimo.frame.framePeriodicity  # stampe frame time in ms
     _logger.info(f"frame_periodicity: {frame_periodicity}")
     x_sample_num = cfg.bracket.profile.col
-    y_sample_num = cfg.bracket.profile.row
     offset_time = cfg.bracket.profile.offset_time  # 手动偏移校准
-    next_line_reverse = cfg.bracket.profile.next_line_reverse
-    _logger.info(f"next_line_reverse: {next_line_reverse}")
+    _logger.info(f"next_line_reverse: {cfg.bracket.profile.next_line_reverse}")
     num_frames = cfg.mimo.frame.numFrames
     _logger.info(f"num_frames: {num_frames}, need record time:{num_frames * frame_periodicity / 1000}s")
-
-    bracket_idx, _ = get_bracket_idx(input_dir, x_sample_num, frame_periodicity)
-    array_shape = (16, 12, y_sample_num, x_sample_num, adc_samples_num, 2)
-
-    all_mmw_array = np.zeros(array_shape, dtype=np.int16)
-
-    bin_files_path, idxs_path = get_data_files_path(input_dir, "master")
-    data_idx = get_data_idx(idxs_path, offset_time, frame_periodicity)
-    _logger.info(f"record time:{data_idx[-1] * frame_periodicity / 1000}s")
+    stream = cfg.repack.profile.stream
+    engine = cfg.repack.profile.engine
+    if engine == "process" and not stream:
+        # 进程池把输出放在 /dev/shm 里，容器中通常只有 64MB，放不下时写到磁盘上的 memmap，而不是中途 SIGBUS
+        needed = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in get_output_shapes(cfg).values())
+        free = shared_memory_free()
+        if free is not None and needed > 0.9 * free:
+            _logger.warning(
+                f"outputs need {needed / 2**20:.0f} MB but {shm_path} has {free / 2**20:.0f} MB free, stream them to disk"
+            )
+            cfg = cfg.model_copy(deep=True)
+            cfg.repack.profile.stream = stream = True  # 子进程按 stream 释放驻留页
+
+    from .capture_index import load_capture_index
+
+    with stage_timer(timings, "index"):
+        bracket_idx, _ = get_bracket_idx(input_dir, x_sample_num, frame_periodicity)
+        index = load_capture_index(input_dir)
+        data_idx = index.align(offset_time, frame_periodicity)
+        file_frames = {device: index.file_frames(device) for device in index.devices}
+    _logger.info(f"record time:{data_idx['master'][-1] * frame_periodicity / 1000}s")
 
     # for device_name in ["master", "slave1", "slave2", "slave3"]:
     #     bin_files_path, idxs_path = get_data_files_path(input_dir, device_name)
@@ -296,20 +840,258 @@ def turn_frame(input_dir: Path, cfg: schemas.MMWConfig):
     #     mmw_frame = MMWFrame(bin_files_path, adc_samples_num, chrips_num, data_idx)
     #     turn_device_frame(all_mmw_array, mmw_frame, rx_tabel[device_name], chrip_idx, bracket_idx, next_line_reverse)
 
-    def ithread(device_name):
-        bin_files_path, idxs_path = get_data_files_path(input_dir, device_name)
-        mmw_frame = MMWFrame(bin_files_path, adc_samples_num, chrips_num, data_idx)
-        turn_device_frame(all_mmw_array, mmw_frame, rx_tabel[device_name], chrip_idx, bracket_idx, next_line_reverse)
-
-    with ThreadPoolExecutor() as executor:
-        for device_name in ["master", "slave1", "slave2", "slave3"]:
-            executor.submit(ithread, device_name)
+    with stage_timer(timings, "mask"):
+        mask = get_devices_valid_mask(input_dir, cfg, data_idx, file_frames, bracket_idx)
+        save_valid_mask(input_dir / "valid_mask.npz", mask)
+
+    outputs: dict[str, RepackOutput] = {}
+    try:
+        with stage_timer(timings, "repack"):
+            outputs = get_repack_outputs(input_dir, cfg, stream, engine)
+            specs = {name: output.spec for name, output in outputs.items()}
+            run_repack_blocks(specs, input_dir, cfg, data_idx, file_frames, bracket_idx)
+        with stage_timer(timings, "finish"):
+            finish_outputs(outputs, cfg, mask)
+    finally:
+        for output in outputs.values():
+            output.close()
+
+
+def get_devices_valid_mask(
+    input_dir: Path,
+    cfg: schemas.MMWConfig,
+    data_idx: dict[str, np.ndarray],
+    file_frames: dict[str, np.ndarray],
+    bracket_idx: np.ndarray,
+    partial=False,
+):
+    """(device, row, col) validity mask of all devices, see get_valid_mask.
 
-    np.save(input_dir / "all_mmw_array.npy", all_mmw_array)
+    data_idx: scan frame numbers of each device, see CaptureIndex.align
+    file_frames: frames of each idx file of each device, see CaptureIndex.file_frames
+    Devices missing from data_idx (not recorded, or left out by the roi) stay all False.
+    """
+    mask = np.zeros((len(devices), bracket_idx.shape[0], cfg.bracket.profile.col), dtype=bool)
+    for d, device_name in enumerate(devices):
+        if device_name not in data_idx:
+            continue
+        bin_files_path, _ = get_data_files_path(input_dir, device_name)
+        frames = FrameArray(
+            bin_files_path, cfg.mimo.profile.numAdcSamples, cfg.mimo.frame.numLoops, file_frames[device_name], partial=partial
+        )
+        mask[d] = get_valid_mask(
+            data_idx[device_name],
+            bracket_idx,
+            cfg.bracket.profile.col,
+            len(frames),
+            cfg.bracket.profile.next_line_reverse,
+        )
+    _logger.info(f"valid scan positions: {mask.mean() * 100:.2f}%")
+    return mask
+
+
+def get_output_shapes(cfg: schemas.MMWConfig):
+    """{name: (shape, dtype)} of the output arrays selected by cfg.repack.profile."""
+    profile = cfg.repack.profile
+    roi = RepackROI(cfg)
+    shapes = {}
+    if profile.raw_cube or not profile.range_fft:
+        shapes["frame"] = ((*roi.shape, *get_chirp_shape(cfg), cfg.mimo.profile.numAdcSamples, 2), np.int16)
+    if profile.range_fft:
+        shapes["range_profile"] = ((*roi.shape, *get_chirp_shape(cfg), get_range_bins(cfg).shape[0]), np.complex64)
+    return shapes
+
+
+def shared_memory_free():
+    """Free bytes of the tmpfs behind SharedMemory, None where there is no /dev/shm (Windows, macOS)."""
+    if not shm_path.is_dir():
+        return None
+    return shutil.disk_usage(shm_path).free
+
+
+def get_repack_outputs(input_dir: Path, cfg: schemas.MMWConfig, stream=False, engine="process"):
+    """Create the output arrays selected by cfg.repack.profile."""
+    profile = cfg.repack.profile
+    roi = RepackROI(cfg)
+    range_bins = get_range_bins(cfg) if profile.range_fft else None  # 在分配输出之前检查
+    prefix = roi.prefix
+    file_names = {"frame": f"{prefix}all_mmw_array.npy", "range_profile": f"{prefix}range_profile.npy"}
+    outputs: dict[str, RepackOutput] = {}
+    try:
+        if not roi.full:
+            _logger.info(f"repack roi {roi.shape}, devices {roi.devices}")
+            roi.save(input_dir / "roi.json")
+        for name, (shape, dtype) in get_output_shapes(cfg).items():
+            outputs[name] = RepackOutput(input_dir / file_names[name], shape, dtype, stream, engine)
+        if profile.range_fft:
+            _logger.info(f"range fft keep {range_bins.shape[0]} bins")
+            np.save(input_dir / f"{prefix}range_bins.npy", range_bins)
+    except Exception:
+        for output in outputs.values():
+            output.close()
+        raise
+    return outputs
+
+
+def finish_outputs(outputs: dict, cfg: schemas.MMWConfig, mask: np.ndarray):
+    """Save the repacked outputs, run the post stages (gap filling, chunked layout) and record them in the cache manifest."""
+    from .chunked import apply_layout, cube_axes, profile_axes
+
+    roi = RepackROI(cfg)
+    for name, output in outputs.items():
+        output.save()
+        if cfg.repack.profile.fill_gaps:
+            fill_file_gaps(output.file_path, roi.take_mask(rx_valid_mask(mask)), cfg.repack.profile.fill_gaps)
+        axes = cube_axes if name == "frame" else profile_axes
+        if get_chirp_shape(cfg):
+            axes = (*axes[:4], "chirp", *axes[4:])
+        apply_layout(output.file_path, axes, cfg.repack.profile.layout, cfg.repack.profile.chunks)
+
+    if outputs:
+        from .cache import write_manifest
+
+        input_dir = next(iter(outputs.values())).file_path.parent
+        write_manifest(input_dir, cfg, {roi.prefix + name: output.file_path for name, output in outputs.items()})
+
+
+def fill_file_gaps(file_path: Path, rx_mask: np.ndarray, method="linear", block_rows: int = 8):
+    """Fill the missing frames of a repacked .npy in place through a memmap."""
+    from .gapfill import fill_gaps
+
+    data = np.load(file_path, mmap_mode="r+")
+    fill_gaps(data, rx_mask, method, block_rows)
+    release_pages(data)
+    del data
+
+
+def run_repack_blocks(
+    outputs: dict,
+    input_dir: Path,
+    cfg: schemas.MMWConfig,
+    data_idx: dict[str, np.ndarray],
+    file_frames: dict[str, np.ndarray],
+    bracket_idx: np.ndarray,
+):
+    """Schedule turn_block_frame over every (device, output row block) pair, only the devices of the roi are read.
 
+    Every device is placed with its own scan frame numbers data_idx[device], see CaptureIndex.align,
+    and its frames are addressed by the idx file frame counts file_frames[device].
 
-def main():
-    import sys
+    Progress is reported per finished block. The first failing block cancels the blocks that have
+    not started yet and is re-raised with the device and line range attached.
+    """
+    from tqdm.auto import tqdm
+
+    engine = cfg.repack.profile.engine
+    workers = cfg.repack.profile.workers or os.cpu_count()
+    block_lines = cfg.repack.profile.block_lines
+
+    roi = RepackROI(cfg)
+    lines_num = roi.rows.shape[0]
+    blocks = [range(i, min(i + block_lines, lines_num)) for i in range(0, lines_num, block_lines)]
+    Executor = ProcessPoolExecutor if engine == "process" else ThreadPoolExecutor
+
+    with Executor(max_workers=workers) as executor, tqdm(total=lines_num * len(roi.devices), unit="line") as pbar:
+        futures = {}
+        for lines in blocks:  # 按行块交错提交各设备，使各设备的进度大致同步
+            for device_name in roi.devices:
+                future = executor.submit(
+                    turn_block_frame,
+                    outputs,
+                    input_dir,
+                    cfg,
+                    device_name,
+                    data_idx[device_name],
+                    file_frames[device_name],
+                    bracket_idx,
+                    lines,
+                )
+                futures[future] = (device_name, lines)
+
+        for future in as_completed(futures):
+            device_name, lines = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise RuntimeError(f"repack {device_name} lines {lines.start}:{lines.stop} failed: {e!r}") from e
+            pbar.update(len(lines))
+
+
+def add_profile_arguments(parser):
+    """Command line flags overriding cfg.repack.profile, shared by repack and repack-batch."""
+    parser.add_argument("--stream", action="store_true", help="write straight into an on-disk memmap")
+    parser.add_argument("--line-buffer", type=int, help="scan lines kept resident per device in stream mode")
+    parser.add_argument("--engine", choices=["process", "thread"], help="run the repack blocks in processes or threads")
+    parser.add_argument("-j", "--workers", type=int, help="number of repack workers, default cpu count")
+    parser.add_argument("--block-lines", type=int, help="scan lines per repack task")
+    parser.add_argument("--range-fft", action="store_true", help="also write complex64 range profiles")
+    parser.add_argument("--range-bins", type=int, nargs="+", help="range bins kept by --range-fft")
+    parser.add_argument("--range-window", type=int, nargs=2, help="range bin window [start, stop) kept by --range-fft")
+    parser.add_argument("--layout", choices=["channel", "range", "pixel"], help="store the output as a chunked array")
+    parser.add_argument("--fill-gaps", choices=["linear", "phase"], help="interpolate missing frames along the scan lines")
+    parser.add_argument("--no-raw", action="store_true", help="with --range-fft, skip the int16 all_mmw_array.npy")
+    parser.add_argument("--tx", type=int, nargs="+", help="tx channels (0~11) to repack into roi_*.npy")
+    parser.add_argument("--rx-devices", nargs="+", choices=devices, help="devices whose rx channels are repacked")
+    parser.add_argument("--rows", type=int, nargs=2, help="scan line window [start, stop)")
+    parser.add_argument("--cols", type=int, nargs=2, help="scan position window [start, stop)")
+    parser.add_argument("--stride", type=int, nargs=2, help="row and col decimation")
+    parser.add_argument("--readahead", type=int, help="scan lines read ahead in the background, 0 disables the hints")
+    parser.add_argument("--prefetch", action="store_true", help="copy the read-ahead lines in a reader thread")
+    parser.add_argument("--chirp-mode", choices=["select", "mean", "all"], help="pick, average or keep the chirp loops")
+    parser.add_argument("--chirp-idx", type=int, help="chirp loop kept by --chirp-mode select")
+    parser.add_argument("--chirp-window", type=int, nargs=2, help="chirp loops [start, stop) used by mean / all")
+
+
+def apply_profile_arguments(cfg: schemas.MMWConfig, args):
+    """Apply the flags added by add_profile_arguments to cfg in place."""
+    if args.stream:
+        cfg.repack.profile.stream = True
+    if args.line_buffer is not None:
+        cfg.repack.profile.line_buffer = args.line_buffer
+    if args.engine is not None:
+        cfg.repack.profile.engine = args.engine
+    if args.workers is not None:
+        cfg.repack.profile.workers = args.workers
+    if args.block_lines is not None:
+        cfg.repack.profile.block_lines = args.block_lines
+    if args.range_fft:
+        cfg.repack.profile.range_fft = True
+    if args.range_bins is not None:
+        cfg.repack.profile.range_bins = args.range_bins
+    if args.range_window is not None:
+        cfg.repack.profile.range_window = tuple(args.range_window)
+    if args.no_raw:
+        cfg.repack.profile.raw_cube = False
+    if args.layout is not None:
+        cfg.repack.profile.layout = args.layout
+    if args.fill_gaps is not None:
+        cfg.repack.profile.fill_gaps = args.fill_gaps
+    if args.tx is not None:
+        cfg.repack.profile.tx = args.tx
+    if args.rx_devices is not None:
+        cfg.repack.profile.rx_devices = args.rx_devices
+    if args.rows is not None:
+        cfg.repack.profile.rows = tuple(args.rows)
+    if args.cols is not None:
+        cfg.repack.profile.cols = tuple(args.cols)
+    if args.stride is not None:
+        cfg.repack.profile.stride = tuple(args.stride)
+    if args.readahead is not None:
+        cfg.repack.profile.readahead = args.readahead
+    if args.prefetch:
+        cfg.repack.profile.prefetch = True
+    if args.chirp_mode is not None:
+        cfg.repack.profile.chirp_mode = args.chirp_mode
+    if args.chirp_idx is not None:
+        cfg.repack.profile.chirp_idx = args.chirp_idx
+    if args.chirp_window is not None:
+        cfg.repack.profile.chirp_window = tuple(args.chirp_window)
+    return cfg
+
+
+def main(argv: list[str] = None):
+    import argparse
     from rich.console import Console
     from .util import load_config
 
@@ -317,15 +1099,30 @@ def main():
 
     print = Console().print
 
-    args = sys.argv[1:]
-    if args:
-        input_dir = Path(args[0])
-    else:
-        input_dir = Path("../mmwave_postproc/outdoor_20250422_222653")
+    parser = argparse.ArgumentParser(description="Repack raw TI cascade recordings into all_mmw_array.npy")
+    parser.add_argument("input_dir", nargs="?", default="../mmwave_postproc/outdoor_20250422_222653")
+    add_profile_arguments(parser)
+    parser.add_argument("--follow", action="store_true", help="repack line by line while the capture is still recording")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between checks in --follow mode")
+    parser.add_argument("--idle-timeout", type=float, default=60.0, help="finish --follow after this many idle seconds")
+    args = parser.parse_args(argv)
+
+    input_dir = Path(args.input_dir)
     _logger.info(f"read file from {input_dir}")
 
     cfg = load_config(input_dir / "config.toml")
-    turn_frame(input_dir, cfg)
+    apply_profile_arguments(cfg, args)
+
+    try:
+        if args.follow:
+            from .follow import follow_frame
+
+            follow_frame(input_dir, cfg, args.poll, args.idle_timeout)
+        else:
+            turn_frame(input_dir, cfg)
+    except Exception as e:
+        _logger.exception(f"repack {input_dir} failed")
+        raise SystemExit(1) from e
 
 
 if __name__ == "__main__":
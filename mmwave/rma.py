@@ -4,6 +4,9 @@ import matplotlib.pyplot as plt
 from .matlab_cmap import parula_map
 from functools import partial
 
+from .fft_backend import fft, fft2, ifft2
+from .lazy import ResultCache
+
 pad = partial(np.pad, mode="constant", constant_values=0)
 
 
@@ -25,24 +28,197 @@ def align_matrix(a: np.ndarray, b: np.ndarray):
     return a, b
 
 
-def rma(sarData, dx, dy, R, k):
-    nFFTspace = 512  # Number of FFT points for Spatial-FFT
+# kz 网格按 (dx, dy, k, nFFTspace) 缓存，相位因子再按 R 缓存，拖动距离滑块时只剩 FFT 和乘法
+phase_cache = ResultCache(256 * 2**20)
 
+
+def kz_grid(dx, dy, k, nFFTspace=512, dtype=np.float64):
+    """fftshift-ed kz = sqrt((2k)^2 - kx^2 - ky^2) of the spatial FFT grid, 0 for evanescent waves.
+
+    Grids are kept in phase_cache and returned read only.
+    """
+    key = ("kz", float(dx), float(dy), float(k), int(nFFTspace), np.dtype(dtype).str)
+    K = phase_cache.get(key)
+    if K is not None:
+        return K
     wSx, wSy = 2 * np.pi / np.array([dx, dy]) / 1e-3  # Sampling space for Target Domain
     kX = np.linspace(-wSx / 2, wSx / 2, nFFTspace)[np.newaxis, :]  # kX-Domain
     kY = np.linspace(-wSy / 2, wSy / 2, nFFTspace)[:, np.newaxis]  # kY-Domain
     K = (2 * k) ** 2 - (kX**2 + kY**2)  # 求kz
     K = np.sqrt(K, where=K > 0, out=np.zeros_like(K))
+    K = np.fft.fftshift(K).astype(dtype, copy=False)
+    phase_cache.put(key, K)
+    return K
+
+
+def phase_factor(dx, dy, R, k, nFFTspace=512, dtype=np.complex128):
+    """Matched filter that focuses the spatial spectrum of an echo at range R, cached like kz_grid."""
+    key = ("phase", float(dx), float(dy), float(R), float(k), int(nFFTspace), np.dtype(dtype).str)
+    phaseFactor = phase_cache.get(key)
+    if phaseFactor is not None:
+        return phaseFactor
+    K = kz_grid(dx, dy, k, nFFTspace, np.finfo(dtype).dtype)
+    phaseFactor = K * np.exp(-1j * np.finfo(dtype).dtype.type(R) * K)
+    phase_cache.put(key, phaseFactor)
+    return phaseFactor
+
+
+def center_pad(sarData: np.ndarray, nFFTspace=512):
+    """Zero pad the last two axes to nFFTspace (or (ny, nx)) with the aperture in the middle, like align_matrix."""
+    ny, nx = (nFFTspace, nFFTspace) if np.ndim(nFFTspace) == 0 else nFFTspace
+    row, col = sarData.shape[-2:]
+    if row > ny or col > nx:
+        raise ValueError(f"aperture {row}x{col} is larger than nFFTspace {ny}x{nx}")
+    pad_width = [(0, 0)] * (sarData.ndim - 2)
+    pad_width += [((n - m) // 2, n - m - (n - m) // 2) for m, n in ((row, ny), (col, nx))]
+    return pad(sarData, pad_width)
+
 
-    phaseFactor = np.fft.fftshift(K * np.exp(-1j * R * K))
+def rma(sarData, dx, dy, R, k):
+    nFFTspace = 512  # Number of FFT points for Spatial-FFT
+
+    phaseFactor = phase_factor(dx, dy, R, k, nFFTspace)
 
     sarData, phaseFactor = align_matrix(sarData, phaseFactor)
 
-    sarDataFFT = np.fft.fft2(sarData, s=[nFFTspace, nFFTspace])
-    sarImage_2DRMA = np.fft.ifft2(sarDataFFT * phaseFactor)
+    sarDataFFT = fft2(sarData, s=[nFFTspace, nFFTspace])
+    sarImage_2DRMA = ifft2(sarDataFFT * phaseFactor)
     return sarImage_2DRMA
 
 
+def rma_batch(sarData, dx, dy, R, k, nFFTspace=512, batch=16, out: np.ndarray = None):
+    """RMA of a stack of echoes scanned on the same grid, e.g. all channels or a window of range bins.
+
+    The phase factors come from phase_cache, built once per (R, k), and every batch of echoes is
+    padded and transformed by a single FFT call over the last two axes.
+
+    Arguments:
+        sarData: (N, row, col) echoes, complex64 echoes are imaged in complex64
+        R, k: focus range in m and wave number of every echo, a scalar or (N,)
+        batch: echoes transformed per FFT call, bounds the temporary memory
+        out: (N, nFFTspace, nFFTspace) array (e.g. an open_memmap) to write the images into
+    Return:
+        (N, nFFTspace, nFFTspace) images, rma_batch(sarData, ...)[i] == rma(sarData[i], ...)
+    """
+    sarData = np.asarray(sarData)
+    n = sarData.shape[0]
+    R = np.broadcast_to(np.asarray(R, dtype=np.float64), (n,))
+    k = np.broadcast_to(np.asarray(k, dtype=np.float64), (n,))
+    dtype = np.result_type(sarData.dtype, np.complex64)
+    if out is None:
+        out = np.empty((n, nFFTspace, nFFTspace), dtype=dtype)
+    elif out.shape != (n, nFFTspace, nFFTspace):
+        raise ValueError(f"out has shape {out.shape}, expected {(n, nFFTspace, nFFTspace)}")
+
+    for start in range(0, n, batch):
+        stop = min(n, start + batch)
+        factors = [phase_factor(dx, dy, r, kk, nFFTspace, dtype) for r, kk in zip(R[start:stop], k[start:stop])]
+        # 所有通道同一距离时广播同一个因子，不复制
+        phaseFactor = factors[0] if all(f is factors[0] for f in factors) else np.stack(factors)
+        sarDataFFT = fft2(center_pad(sarData[start:stop].astype(dtype, copy=False), nFFTspace))
+        sarDataFFT *= phaseFactor
+        out[start:stop] = ifft2(sarDataFFT)
+    return out
+
+
+def chirp_wavenumbers(cfg):
+    """Wave number k = 2 pi f / c of every ADC sample of the chirp, (numAdcSamples,)."""
+    from scipy import constants as C
+
+    profile = cfg.mimo.profile
+    slope = profile.frequencySlope * 1e12  # Hz/s
+    t = profile.adcStartTime * 1e-6 + np.arange(profile.numAdcSamples) / (profile.adcSamplingFrequency * 1e3)
+    return 2 * np.pi * (profile.startFrequency * 1e9 + slope * t) / C.c
+
+
+def rma_3d(
+    echo,
+    dx,
+    dy,
+    k: np.ndarray,
+    z_range=(0.0, 1.0),
+    nz: int = None,
+    nFFTspace=512,
+    dtype=np.complex64,
+    chunk_bytes: int = 64 * 2**20,
+    out: np.ndarray = None,
+):
+    """Wideband 3D range migration of a planar scan, every ADC sample of the chirp is used.
+
+    The echo is transformed over the aperture sample block by sample block, referenced to z_min
+    and Stolt-interpolated (linearly, per kx / ky row block) from the uniform k of the chirp onto a
+    uniform kz grid. An FFT over kz then gives range and an inverse FFT over kx / ky the position.
+    Only the (ny, nx, nz) spectrum / image is held in full, pass an open_memmap as out to keep it
+    on disk.
+
+    Arguments:
+        echo: (row, col, samples) raw complex echo, e.g. frame_file[rx, tx].to_complex()
+        k: (samples,) wave number of every sample, see chirp_wavenumbers
+        z_range: (z_min, z_max) depth window in m, longer depths wrap around into it
+        nz: depth bins, default so that kz covers all propagating waves of the chirp band
+        nFFTspace: spatial FFT size, an int or (ny, nx)
+        dtype: complex64 halves the memory of complex128
+        chunk_bytes: size of the temporary arrays of one block
+        out: (ny, nx, nz) array of dtype to write the image into
+    Return:
+        image: (ny, nx, nz), pixel (i, j) is padded aperture position (i, j) like rma
+        z: (nz,) depth of every bin in m
+    """
+    ny, nx = (nFFTspace, nFFTspace) if np.ndim(nFFTspace) == 0 else nFFTspace
+    k = np.asarray(k, dtype=np.float64)
+    nk = k.shape[0]
+    if echo.shape[-1] != nk:
+        raise ValueError(f"echo has {echo.shape[-1]} samples, k has {nk}")
+    dk = (k[-1] - k[0]) / (nk - 1)
+    real = np.finfo(dtype).dtype
+    itemsize = np.dtype(dtype).itemsize
+
+    kx = 2 * np.pi * np.fft.fftfreq(nx, dx * 1e-3)
+    ky = 2 * np.pi * np.fft.fftfreq(ny, dy * 1e-3)
+    z_min, z_max = z_range
+    dkz = 2 * np.pi / (z_max - z_min)  # 深度窗口就是 kz 采样的不模糊距离
+    kz_hi = 2 * k[-1]
+    kz_lo = np.sqrt(max(0.0, 4 * k[0] ** 2 - kx.max() ** 2 - ky.max() ** 2))
+    if nz is None:
+        nz = int(np.ceil((kz_hi - kz_lo) / dkz)) + 1
+    kz = kz_hi - dkz * np.arange(nz)[::-1]
+    z = z_min + np.arange(nz) * (z_max - z_min) / nz
+
+    # 1. 沿孔径的二维 FFT，按采样点分块读取
+    spectrum = np.empty((ny, nx, nk), dtype=dtype)
+    step = max(1, chunk_bytes // (ny * nx * itemsize * 2))
+    for s0 in range(0, nk, step):
+        block = np.asarray(echo[:, :, s0 : s0 + step]).astype(dtype, copy=False)
+        block = fft2(center_pad(np.moveaxis(block, -1, 0), (ny, nx)))
+        spectrum[:, :, s0 : s0 + step] = np.moveaxis(block, 0, -1)
+
+    # 2. 参考相位 + Stolt 插值 + kz 方向 FFT，每个 (ky, kx) 独立，按 ky 行分块
+    if out is None:
+        out = spectrum if nz == nk else np.empty((ny, nx, nz), dtype=dtype)
+    elif out.shape != (ny, nx, nz):
+        raise ValueError(f"out has shape {out.shape}, expected {(ny, nx, nz)}")
+    rows = max(1, chunk_bytes // (nx * max(nz, nk) * 64))  # 插值的索引、权重和临时数组
+    for r0 in range(0, ny, rows):
+        rho2 = (ky[r0 : r0 + rows, None] ** 2 + kx[None, :] ** 2)[..., None]  # (rows, nx, 1)
+        kz_k = np.sqrt(np.maximum(4 * k**2 - rho2, 0))
+        S = spectrum[r0 : r0 + rows] * np.exp(-1j * (kz_k * z_min).astype(real))
+        S[4 * k**2 <= rho2] = 0  # 倏逝波
+
+        pos = (np.sqrt(kz**2 + rho2) / 2 - k[0]) / dk  # 每个 kz 对应的采样点位置
+        valid = (pos >= 0) & (pos <= nk - 1)
+        i0 = np.clip(pos.astype(np.int64), 0, nk - 2)
+        frac = (pos - i0).astype(real)
+        stolt = np.take_along_axis(S, i0, axis=-1) * (1 - frac) + np.take_along_axis(S, i0 + 1, axis=-1) * frac
+        stolt[~valid] = 0
+        out[r0 : r0 + rows] = fft(stolt, axis=-1)
+
+    # 3. kx / ky 方向逆 FFT，按深度分块
+    step = max(1, chunk_bytes // (ny * nx * itemsize * 2))
+    for z0 in range(0, nz, step):
+        out[:, :, z0 : z0 + step] = ifft2(out[:, :, z0 : z0 + step], axes=(0, 1))
+    return out, z
+
+
 def unwarp_2d(echo_data):
     Echo_abs = np.abs(echo_data)
     Echo_abs_log = 40 * np.log10(Echo_abs / np.max(Echo_abs))
@@ -117,7 +293,8 @@ def main():
     from scipy import constants as C
     import matplotlib.pyplot as plt
     from mmwave.rma import rma, echo_plot
-    from mmwave.util import load_frame
+    from mmwave.util import load_frame, load_range_profile
+    from mmwave.repack import load_valid_mask
     import sys
     import matplotlib
 
@@ -129,7 +306,17 @@ def main():
     else:
         input_dir = Path("../mmwave_postproc/cas_data/outdoor_20250422_222653")
 
-    frame_file, cfg = load_frame(input_dir)
+    tx_idx = 1
+    rx_idx = 1
+    ID_select = 21
+
+    # 有重组时算好的距离像就直接用，不用再对整个回波做 FFT
+    range_bins = np.load(input_dir / "range_bins.npy") if (input_dir / "range_bins.npy").exists() else []
+    if ID_select - 1 in range_bins:
+        range_profile, range_bins, cfg = load_range_profile(input_dir)
+        frame_file = None
+    else:
+        frame_file, cfg = load_frame(input_dir)
 
     num_sample = cfg.mimo.profile.numAdcSamples
     adcStartTime = cfg.mimo.profile.adcStartTime  # us
@@ -148,18 +335,20 @@ def main():
     Ts = 1 / Fs  # Sampling period
     k = 2 * np.pi * F0 / c  # Wave number
     print(f"k:{k}")
-    tx_idx = 1
-    rx_idx = 1
 
-    Echo = frame_file[rx_idx, tx_idx, :, :, :, 0] + 1j * frame_file[rx_idx, tx_idx, :, :, :, 1]
-    ID_select = 21
     nFFTtime = num_sample  # Number of FFT points for Spatial-FFT
     tI = 183  # mm
 
     R = c / 2 * (ID_select / (K * Ts * nFFTtime)) - tI / 1000
-    Sr: np.ndarray = np.fft.fft(Echo)
-    Sr = Sr[:, :, ID_select - 1]
-    Sr[Sr == 0] = 1e-10
+    if frame_file is None:
+        Sr = np.array(range_profile[rx_idx, tx_idx, :, :, np.flatnonzero(range_bins == ID_select - 1)[0]])
+    else:
+        # 只读取一个通道，按行分块做 FFT；cache=False 得到可写的新数组
+        Sr = frame_file[rx_idx, tx_idx].to_complex().range_fft()[..., ID_select - 1].compute(cache=False)
+    if (input_dir / "valid_mask.npz").exists():
+        Sr[~load_valid_mask(input_dir / "valid_mask.npz", rx=True)[rx_idx]] = 1e-10
+    else:
+        Sr[Sr == 0] = 1e-10
     echo_plot(Sr, "source", dx, dy)
     plt.show()
     reconstructed_image = rma(Sr, dx, dy, R, k)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Literal, Optional
 
 
 class MimoProfile(BaseModel):
@@ -42,6 +42,31 @@ class BracketProfile(BaseModel):
     pre_acc: bool = False
 
 
+class RepackProfile(BaseModel):
+    stream: bool = False  # 直接写入磁盘上的 memmap，不在内存中分配整个数组
+    line_buffer: int = 8  # stream 模式下每写多少行释放一次驻留页
+    engine: Literal["process", "thread"] = "process"  # 重组任务在进程池还是线程池中运行
+    workers: Optional[int] = None  # 并行任务数，默认为 CPU 核数
+    block_lines: int = 16  # 每个重组任务处理的扫描行数
+    readahead: int = 2  # 提前让内核在后台读取的扫描行数，0 为不预读
+    prefetch: bool = False  # 另开一个读线程把预读的行拷贝到缓冲区
+    range_fft: bool = False  # 重组时顺带做距离向 FFT，输出 range_profile.npy (complex64)
+    range_bins: Optional[list[int]] = None  # 保留的距离单元，优先于 range_window
+    range_window: Optional[tuple[int, int]] = None  # 保留的距离单元窗口 [start, stop)
+    raw_cube: bool = True  # range_fft 时是否仍输出 int16 的 all_mmw_array.npy
+    fill_gaps: Optional[Literal["linear", "phase"]] = None  # 沿扫描线插值补齐丢帧，None 为保留 0
+    layout: Optional[Literal["channel", "range", "pixel"]] = None  # 分块存储布局，None 为普通 .npy
+    chunks: Optional[dict[str, int]] = None  # 覆盖布局预设的块大小，如 {"row": 16, "col": 16}
+    tx: Optional[list[int]] = None  # 只重组这些发射通道 (0~11)，输出 roi_*.npy
+    rx_devices: Optional[list[str]] = None  # 只读取这些设备的接收通道
+    rows: Optional[tuple[int, int]] = None  # 扫描行窗口 [start, stop)
+    cols: Optional[tuple[int, int]] = None  # 扫描列窗口 [start, stop)
+    stride: tuple[int, int] = (1, 1)  # 行、列降采样步长
+    chirp_mode: Literal["select", "mean", "all"] = "select"  # 取一个 chirp loop / 相干平均 / 全部保留
+    chirp_idx: Optional[int] = None  # select 模式取的 loop，默认为 min(1, numLoops - 1)
+    chirp_window: Optional[tuple[int, int]] = None  # mean / all 模式使用的 loop 窗口 [start, stop)，默认全部
+
+
 class MimoConfig(BaseModel):
     profile: MimoProfile = MimoProfile()
     frame: MimoFrame = MimoFrame()
@@ -52,6 +77,11 @@ class BracketConfig(BaseModel):
     profile: BracketProfile = BracketProfile()
 
 
+class RepackConfig(BaseModel):
+    profile: RepackProfile = RepackProfile()
+
+
 class MMWConfig(BaseModel):
     mimo: MimoConfig = MimoConfig()
     bracket: BracketConfig = BracketConfig()
+    repack: RepackConfig = RepackConfig()
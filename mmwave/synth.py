@@ -0,0 +1,211 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+from scipy import constants as C
+
+from mmwave import schemas
+from .repack import devices, idx_header_dtype, idx_record_dtype, rx_tabel
+from .util import turn_toml
+
+_logger = logging.getLogger(__name__)
+
+ntx = 12  # 4 片级联，每片 3 发
+nrx = 4  # 每片 4 收
+
+
+def scan_frames(cfg: schemas.MMWConfig, line_gap: int = 10, lead_frames: int = 20, tail_frames: int = 20):
+    """Frame layout of a synthetic scan.
+
+    The scanner records lead_frames before the first line, moves line_gap frames between two
+    lines and keeps recording tail_frames after the last one.
+
+    Return:
+        frames_num: total frames recorded
+        line_start: first frame of every scan line
+        row, col: scan position of every frame, -1 for frames outside a line
+    """
+    row_num, col_num = cfg.bracket.profile.row, cfg.bracket.profile.col
+    line_start = lead_frames + np.arange(row_num) * (col_num + line_gap)
+    frames_num = int(line_start[-1]) + col_num + tail_frames
+
+    row = np.full(frames_num, -1)
+    col = np.full(frames_num, -1)
+    for i, start in enumerate(line_start):
+        cols = np.arange(col_num)
+        if cfg.bracket.profile.next_line_reverse and i % 2:
+            cols = cols[::-1]  # 回程扫描
+        row[start : start + col_num] = i
+        col[start : start + col_num] = cols
+    return frames_num, line_start, row, col
+
+
+def point_echo(cfg: schemas.MMWConfig, row: np.ndarray, col: np.ndarray, target=(0.0, 0.0, 0.5), channel_phase=None):
+    """Beat signal of a single point target seen from the given scan positions.
+
+    Arguments:
+        row, col: (frames,) scan position, -1 gives no echo
+        target: (x, y, z) in m, x / y measured from the first scan position along col / row
+        channel_phase: (12, 16) phase offset of each tx / rx pair
+    Return:
+        (frames, 12, samples, 16) complex64 echo with unit amplitude
+    """
+    profile = cfg.mimo.profile
+    slope = profile.frequencySlope * 1e12  # Hz/s
+    fs = profile.adcSamplingFrequency * 1e3
+    f0 = profile.startFrequency * 1e9 + profile.adcStartTime * 1e-6 * slope
+    t = np.arange(profile.numAdcSamples) / fs
+
+    x = col * cfg.bracket.profile.dx / 1000
+    y = row * cfg.bracket.profile.dy / 1000
+    r = np.sqrt((x - target[0]) ** 2 + (y - target[1]) ** 2 + target[2] ** 2)
+    tau = 2 * r / C.c
+    echo = np.exp(2j * np.pi * (f0 * tau[:, None] + slope * tau[:, None] * t)).astype(np.complex64)
+    echo[row < 0] = 0
+
+    echo = echo[:, None, :, None]  # (frames, tx, samples, rx)
+    if channel_phase is not None:
+        echo = echo * np.exp(1j * channel_phase[None, :, None, :]).astype(np.complex64)
+    return np.broadcast_to(echo, (echo.shape[0], ntx, echo.shape[2], 16))
+
+
+def make_capture(
+    output_dir: Path,
+    cfg: schemas.MMWConfig = None,
+    files: int = 2,
+    line_gap: int = 10,
+    drop=(),
+    drop_rate: float = 0.0,
+    jitter_us: float = 0.0,
+    device_drop: dict[str, list[int]] = None,
+    device_skew_us: dict[str, float] = None,
+    target=(0.0, 0.0, 0.5),
+    amplitude: float = 1000,
+    noise: float = 20,
+    seed: int = 0,
+    chunk_frames: int = 256,
+):
+    """Write a synthetic 4-chip cascade capture that repack reads like a real one.
+
+    Every device gets *_data.bin / *_idx.bin files split into `files` parts, next to them go
+    timestamps.txt and config.toml. The ADC samples hold the echo of one point target plus
+    gaussian noise, so the repacked cube can also be imaged with rma.
+
+    Arguments:
+        cfg: capture settings, numAdcSamples, numLoops, framePeriodicity, row, col, dx, dy,
+            offset_time and next_line_reverse are used, default MMWConfig()
+        drop: frames missing from every device
+        drop_rate: probability of every other frame to be dropped as well
+        jitter_us: standard deviation of the frame timestamp jitter
+        device_drop: frames missing from a single device only, e.g. {"slave2": [40, 41]}
+        device_skew_us: constant timestamp offset of a device against master
+    Return:
+        The MMWConfig written to config.toml
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cfg = cfg.model_copy(deep=True) if cfg is not None else schemas.MMWConfig()
+    rng = np.random.default_rng(seed)
+
+    samples_num = cfg.mimo.profile.numAdcSamples
+    chrips_num = cfg.mimo.frame.numLoops
+    period = cfg.mimo.frame.framePeriodicity  # ms
+    offset_time = cfg.bracket.profile.offset_time
+
+    frames_num, line_start, row, col = scan_frames(cfg, line_gap)
+    cfg.mimo.frame.numFrames = frames_num
+
+    dropped = np.zeros(frames_num, dtype=bool)
+    dropped[np.asarray(drop, dtype=int)] = True
+    dropped |= rng.random(frames_num) < drop_rate
+    dropped[0] = False  # repack 以第一帧的时间为零点
+    keep = np.flatnonzero(~dropped)
+
+    # 扫描线时间与 repack 中 data_idx = (t - t0 + offset_time) / period 对齐
+    line_time = line_start * period / 1000 + offset_time
+    time_info = np.stack((line_time, line_time + cfg.bracket.profile.col * period / 1000), axis=-1)
+    np.savetxt(output_dir / "timestamps.txt", np.concatenate((time_info, [[offset_time, 0]])))
+    turn_toml(output_dir / "config.toml", cfg.model_dump(exclude_none=True))
+
+    channel_phase = rng.uniform(-np.pi, np.pi, (ntx, 16))
+    frame_items = chrips_num * ntx * samples_num * nrx * 2
+    frame_time = 1_000_000 + np.arange(frames_num) * period * 1000 + rng.normal(0, jitter_us, frames_num)
+
+    for device_name in devices:
+        rx = rx_tabel[device_name]
+        device_keep = np.setdiff1d(keep, (device_drop or {}).get(device_name, []))
+        device_time = frame_time[device_keep] + (device_skew_us or {}).get(device_name, 0.0)
+        device_time = np.rint(device_time).astype(np.uint64)
+        for file_i, part in enumerate(np.array_split(np.arange(device_keep.shape[0]), files)):
+            data_path = output_dir / f"{device_name}_{file_i:04d}_data.bin"
+            with data_path.open("wb") as f:
+                for c0 in range(0, part.shape[0], chunk_frames):
+                    frames = device_keep[part[c0 : c0 + chunk_frames]]
+                    echo = amplitude * point_echo(cfg, row[frames], col[frames], target, channel_phase)[..., rx]
+                    # (frame, tx, samples, rx) -> (frame, chirp, tx, samples, rx, IQ)
+                    iq = np.stack((echo.real, echo.imag), axis=-1)[:, None]
+                    iq = iq + rng.normal(0, noise, (frames.shape[0], chrips_num, *iq.shape[2:]))
+                    np.clip(np.rint(iq), -32768, 32767).astype(np.int16).tofile(f)
+
+            header = np.zeros(1, dtype=idx_header_dtype)
+            header["numIdx"] = part.shape[0]
+            header["size"] = part.shape[0] * frame_items * 2
+            record = np.zeros(part.shape[0], dtype=idx_record_dtype)
+            record["size"] = frame_items * 2
+            record["timestamp"] = device_time[part]
+            record["offset"] = np.arange(part.shape[0]) * frame_items * 2
+            with (output_dir / f"{device_name}_{file_i:04d}_idx.bin").open("wb") as f:
+                f.write(header.tobytes())
+                f.write(record.tobytes())
+        _logger.info(f"{device_name}: {device_keep.shape[0]} frames, {frames_num - device_keep.shape[0]} dropped")
+    return cfg
+
+
+def main():
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    parser = argparse.ArgumentParser(description="Write a synthetic TI cascade capture for repack tests and benchmarks")
+    parser.add_argument("output_dir")
+    parser.add_argument("--row", type=int, default=16)
+    parser.add_argument("--col", type=int, default=64)
+    parser.add_argument("--samples", type=int, default=256, help="ADC samples per chirp")
+    parser.add_argument("--loops", type=int, default=2, help="chirp loops per frame")
+    parser.add_argument("--period", type=float, default=25.0, help="frame periodicity in ms")
+    parser.add_argument("--files", type=int, default=2, help="data files per device")
+    parser.add_argument("--drop", type=int, nargs="*", default=[], help="frames dropped on every device")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability of a frame to be dropped")
+    parser.add_argument("--jitter", type=float, default=0.0, help="frame timestamp jitter in us")
+    parser.add_argument(
+        "--device-drop", nargs="+", action="append", default=[], metavar="DEV FRAME", help="frames dropped by one device"
+    )
+    parser.add_argument("--skew", nargs=2, action="append", default=[], metavar=("DEV", "US"), help="device clock skew")
+    parser.add_argument("--offset-time", type=float, default=0.0, help="bracket offset_time in s")
+    parser.add_argument("--reverse", action="store_true", help="scan every other line backwards")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cfg = schemas.MMWConfig()
+    cfg.mimo.profile.numAdcSamples = args.samples
+    cfg.mimo.frame.numLoops = args.loops
+    cfg.mimo.frame.framePeriodicity = args.period
+    cfg.bracket.profile.row = args.row
+    cfg.bracket.profile.col = args.col
+    cfg.bracket.profile.offset_time = args.offset_time
+    cfg.bracket.profile.next_line_reverse = args.reverse
+    make_capture(
+        args.output_dir,
+        cfg,
+        files=args.files,
+        drop=args.drop,
+        drop_rate=args.drop_rate,
+        jitter_us=args.jitter,
+        device_drop={device: [int(i) for i in frames] for device, *frames in args.device_drop},
+        device_skew_us={device: float(us) for device, us in args.skew},
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
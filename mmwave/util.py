@@ -78,22 +78,74 @@ def load_config(config_path: str = "config.toml"):
     return cfg
 
 
-def load_frame(input_dir: Path, repack=False):
+def _load_full_config(input_dir: Path):
+    """load_config of a capture with the repack roi options reset, the loaders always read the full cube.
+
+    A roi in config.toml only selects what the repack command line writes to roi_*.npy.
+    """
+    from mmwave.cache import roi_fields
+    from mmwave.schemas import RepackProfile
+
     cfg = load_config(input_dir / "config.toml")
+    for field in roi_fields:
+        setattr(cfg.repack.profile, field, RepackProfile.model_fields[field].default)
+    return cfg
+
+
+def load_frame(input_dir: Path, repack=False):
+    """Load the repacked frame cube, either the flat .npy memmap or its chunked store.
+
+    The cube is repacked when its cache manifest shows the raw files, the relevant config or the
+    repack code changed since it was written, repack=True forces it. Layout and gap filling not set
+    in config.toml are kept as the last repack wrote them, see cache.with_stored_profile.
+
+    Return:
+        frame_file: lazy CaptureArray over the cube, e.g.
+            frame_file[rx, tx].to_complex().range_fft()[..., bin].compute()
+        cfg: MMWConfig of the capture
+    """
+    from mmwave.cache import is_fresh, with_stored_profile
+    from mmwave.chunked import cube_axes, open_array
+    from mmwave.lazy import CaptureArray
+
+    cfg = with_stored_profile(input_dir, _load_full_config(input_dir), "frame")
+    cfg.repack.profile.raw_cube = True  # config.toml 里 range_fft 且 raw_cube = false 时也要写出立方体
     frame_file_path = input_dir / "all_mmw_array.npy"
-    if not frame_file_path.exists() or repack:
+    if repack or not is_fresh(input_dir, cfg, "frame"):
         from mmwave.repack import turn_frame
 
         turn_frame(input_dir, cfg)
 
-    frame_file: np.memmap = np.load(frame_file_path, mmap_mode="r")
+    frame_array = open_array(frame_file_path)
+    axes = getattr(frame_array, "axes", None)
+    if axes is None:  # 平铺的 .npy，chirp_mode all 时 col 之后多一个 chirp 轴
+        axes = cube_axes if frame_array.ndim == len(cube_axes) else (*cube_axes[:4], "chirp", *cube_axes[4:])
+    return CaptureArray(frame_array, axes), cfg
+
+
+def load_range_profile(input_dir: Path, repack=False):
+    """Load the complex64 range profiles written by the repack range FFT stage.
 
-    if frame_file.shape[0] != 16 or frame_file.shape[1] != 12:
+    Like load_frame they are repacked when out of date, the frame cube is only rewritten along
+    with them if it is out of date as well.
+
+    Return:
+        range_profile: (16, 12, row, col, len(range_bins)) memmap
+        range_bins: FFT bin of each profile along the last axis
+        cfg: MMWConfig of the capture
+    """
+    from mmwave.cache import is_fresh, with_stored_profile
+    from mmwave.chunked import open_array
+
+    cfg = with_stored_profile(input_dir, _load_full_config(input_dir), "range_profile")
+    cfg.repack.profile.range_fft = True
+    profile_file_path = input_dir / "range_profile.npy"
+    if repack or not is_fresh(input_dir, cfg, "range_profile"):
         from mmwave.repack import turn_frame
 
-        print("cache array old,return new array")
+        cfg.repack.profile.raw_cube = not is_fresh(input_dir, cfg, "frame")
         turn_frame(input_dir, cfg)
 
-        frame_file: np.memmap = np.load(frame_file_path, mmap_mode="r")
-
-    return frame_file, cfg
+    range_profile: np.memmap = open_array(profile_file_path)
+    range_bins = np.load(input_dir / "range_bins.npy")
+    return range_profile, range_bins, cfg
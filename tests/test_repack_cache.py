@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from mmwave import repack
+from mmwave.batch import is_up_to_date
+from mmwave.cache import is_fresh
+from mmwave.chunked import ChunkedArray, chunked_path
+from mmwave.synth import make_capture
+from mmwave.util import load_config, load_frame
+
+from test_synth_repack import small_config, target
+
+
+@pytest.fixture
+def capture(tmp_path):
+    # slave1 丢了第 1 行的第 2 帧，补齐丢帧时那里不再是 0
+    make_capture(tmp_path, small_config(), device_drop={"slave1": [43]}, target=target)
+    return tmp_path
+
+
+def record_turn_frame(monkeypatch):
+    """Replace repack.turn_frame, load_frame imports it at call time, and return the list of its calls."""
+    calls = []
+    monkeypatch.setattr(repack, "turn_frame", lambda *args, **kwargs: calls.append(args))
+    return calls
+
+
+def test_load_frame_keeps_a_command_line_layout(capture, monkeypatch):
+    repack.main([str(capture), "--layout", "channel"])
+    assert chunked_path(capture / "all_mmw_array.npy").exists()
+
+    turn_frame_calls = record_turn_frame(monkeypatch)
+    frame_file, _ = load_frame(capture)
+    assert not turn_frame_calls
+    assert isinstance(frame_file.source, ChunkedArray)
+    assert chunked_path(capture / "all_mmw_array.npy").exists()
+
+
+def test_load_frame_keeps_a_command_line_gap_fill(capture, monkeypatch):
+    repack.main([str(capture), "--fill-gaps", "linear"])
+    cube = np.load(capture / "all_mmw_array.npy")
+    assert np.any(cube[repack.rx_tabel["slave1"], :, 1, 1] != 0)
+
+    turn_frame_calls = record_turn_frame(monkeypatch)
+    frame_file, _ = load_frame(capture)
+    assert not turn_frame_calls
+    np.testing.assert_array_equal(frame_file.source, cube)
+
+    cfg = load_config(capture / "config.toml")
+    assert is_up_to_date(capture, cfg)
+    cfg.repack.profile.fill_gaps = "phase"  # config.toml 明确要求另一种补齐方式时才重组
+    assert not is_fresh(capture, cfg, "frame")
+
+
+def test_load_frame_writes_the_cube_when_config_skips_it(tmp_path, monkeypatch):
+    cfg = small_config()
+    cfg.repack.profile.range_fft = True
+    cfg.repack.profile.raw_cube = False
+    make_capture(tmp_path, cfg, target=target)
+
+    frame_file, _ = load_frame(tmp_path)
+    assert frame_file.shape == (16, 12, 6, 12, 16, 2)
+
+    turn_frame_calls = record_turn_frame(monkeypatch)
+    load_frame(tmp_path)
+    assert not turn_frame_calls
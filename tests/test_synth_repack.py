@@ -0,0 +1,120 @@
+import logging
+
+import numpy as np
+import pytest
+
+from mmwave import repack, schemas
+from mmwave.repack import load_valid_mask, rx_tabel, turn_frame
+from mmwave.synth import make_capture, point_echo
+
+logging.getLogger("mmwave").setLevel(logging.WARNING)
+
+target = (0.006, 0.004, 0.1)  # 偏离扫描中心，近场，相邻位置的回波相位明显不同
+
+
+def small_config(next_line_reverse=False):
+    cfg = schemas.MMWConfig()
+    cfg.mimo.profile.numAdcSamples = 16
+    cfg.mimo.frame.numLoops = 1
+    cfg.bracket.profile.row = 6
+    cfg.bracket.profile.col = 12
+    cfg.bracket.profile.dx = 2
+    cfg.bracket.profile.dy = 4
+    cfg.bracket.profile.offset_time = 0.0
+    cfg.bracket.profile.next_line_reverse = next_line_reverse
+    return cfg
+
+
+def expected_echo(cfg: schemas.MMWConfig):
+    """(16 rx, 12 tx, row, col, samples) echo of the target without the channel phases."""
+    row_num, col_num = cfg.bracket.profile.row, cfg.bracket.profile.col
+    row, col = np.meshgrid(np.arange(row_num), np.arange(col_num), indexing="ij")
+    echo = point_echo(cfg, row.ravel(), col.ravel(), target)  # (pos, 12 tx, samples, 16 rx)
+    return echo.reshape(row_num, col_num, *echo.shape[1:]).transpose(4, 2, 0, 1, 3)
+
+
+def channel_coherence(cube: np.ndarray, echo: np.ndarray):
+    """|<cube, echo>| / (|cube| |echo|) of every (rx, tx), 1 when the channel is the echo times one constant phase."""
+    inner = np.abs(np.sum(cube * echo.conj(), axis=(2, 3, 4)))
+    return inner / np.sqrt(np.sum(np.abs(cube) ** 2, axis=(2, 3, 4)) * np.sum(np.abs(echo) ** 2, axis=(2, 3, 4)))
+
+
+@pytest.mark.parametrize(
+    "next_line_reverse, device_skew_us",
+    [(False, None), (True, None), (True, {"slave1": 10000.0})],
+    ids=["forward", "reverse", "reverse-skewed-slave1"],
+)
+def test_target_lands_at_its_scan_position(tmp_path, next_line_reverse, device_skew_us):
+    # 第 43 帧是第 1 行的第 2 帧（前导 20 帧，每行 12 帧加 10 帧间隔），回程时在第 10 列
+    cfg = make_capture(
+        tmp_path,
+        small_config(next_line_reverse),
+        device_drop={"slave1": [43]},
+        device_skew_us=device_skew_us,
+        target=target,
+        noise=0,
+    )
+    turn_frame(tmp_path, cfg)
+
+    cube = np.load(tmp_path / "all_mmw_array.npy").astype(np.float32)
+    cube = cube[..., 0] + 1j * cube[..., 1]
+    echo = expected_echo(cfg)
+    assert cube.shape == echo.shape
+
+    # 丢的帧只在 slave1 的 rx 上、在它的扫描位置留下空洞
+    hole = np.zeros(cube.shape[:4], dtype=bool)
+    hole[rx_tabel["slave1"], :, 1, 10 if next_line_reverse else 1] = True
+    np.testing.assert_array_equal(np.all(cube == 0, axis=-1), hole)
+
+    # 其余每个 (row, col) 都是目标的回波，每个 rx / tx 通道只差一个常数相位
+    echo = np.where(hole[..., None], 0, echo)
+    assert channel_coherence(cube, echo).min() > 0.999
+
+    # 对照：列顺序放反，或奇数行的 rx 放反时，相干性明显下降
+    assert channel_coherence(cube, echo[:, :, :, ::-1]).max() < 0.9
+    swapped = cube.copy()
+    swapped[:, :, 1::2] = cube[::-1, :, 1::2]
+    assert channel_coherence(swapped, echo).min() < 0.9
+
+
+def test_roi_matches_the_full_cube(tmp_path):
+    cfg = make_capture(tmp_path, small_config(next_line_reverse=True), target=target, noise=0)
+    turn_frame(tmp_path, cfg)
+    full = np.load(tmp_path / "all_mmw_array.npy")
+
+    cfg.repack.profile.tx = [1, 5]
+    cfg.repack.profile.cols = (3, 11)
+    cfg.repack.profile.rows = (1, 5)  # 含回程行
+    cfg.repack.profile.stride = (1, 2)
+    turn_frame(tmp_path, cfg)
+    roi = np.load(tmp_path / "roi_all_mmw_array.npy")
+    np.testing.assert_array_equal(roi, full[:, [1, 5]][:, :, 1:5, 3:11:2])
+
+
+def test_roi_repacks_without_a_missing_device(tmp_path):
+    cfg = make_capture(tmp_path, small_config(), target=target, noise=0)
+    for path in tmp_path.glob("slave3_*"):
+        path.unlink()
+
+    cfg.repack.profile.rx_devices = ["master", "slave1", "slave2"]
+    turn_frame(tmp_path, cfg)
+    roi = np.load(tmp_path / "roi_all_mmw_array.npy")
+    assert roi.shape[0] == 12
+    mask = load_valid_mask(tmp_path / "valid_mask.npz")
+    assert mask[:3].all() and not mask[3].any()  # 按 devices 顺序，slave3 最后
+
+
+def test_process_engine_streams_when_shared_memory_is_small(tmp_path, monkeypatch):
+    cfg = make_capture(tmp_path, small_config(), target=target)
+    turn_frame(tmp_path, cfg)
+    expected = np.load(tmp_path / "all_mmw_array.npy")
+
+    def no_shared_memory(*args, **kwargs):
+        raise AssertionError("SharedMemory must not be used")
+
+    monkeypatch.setattr(repack, "shared_memory_free", lambda: 1024)  # 像容器里很小的 /dev/shm
+    monkeypatch.setattr(repack.shared_memory, "SharedMemory", no_shared_memory)
+    cfg.repack.profile.engine = "process"
+    turn_frame(tmp_path, cfg)
+    np.testing.assert_array_equal(np.load(tmp_path / "all_mmw_array.npy"), expected)
+    assert not cfg.repack.profile.stream  # 只改了本次重组用的副本